@@ -6,9 +6,15 @@ import matplotlib.pyplot as plt
 from pathlib import Path
 import tempfile
 import os
-from openai import OpenAI
 import PyPDF2
-import re
+
+from digest import digest_text
+from llm_cache import cached_chat_completion
+from llm_client import create_openai_client
+from llm_json import parse_llm_json
+
+# Longer papers are digested rather than cut off
+MAX_PROMPT_CHARS = 8000
 
 # Set page config
 st.set_page_config(
@@ -58,11 +64,11 @@ st.markdown("""
     </style>
 """, unsafe_allow_html=True)
 class RLPaperAnalyzer:
-    def __init__(self):
-        self.client = OpenAI(
-            base_url="https://integrate.api.nvidia.com/v1",
-            api_key="Your api key here"
-        )
+    def __init__(self, timeout: float = 120.0, structured_output: str = None):
+        self.client = create_openai_client("Your api key here")
+        self.timeout = timeout
+        # None, 'json_mode' or 'stream' for the entity and relationship calls
+        self.structured_output = structured_output
         self.valid_types = {
             'theorem', 'equation', 'framework', 'concept', 
             'method', 'policy_based', 'value_based', 'hybrid',
@@ -84,6 +90,12 @@ class RLPaperAnalyzer:
             st.error(f"Error reading PDF: {e}")
             return ""
 
+    def condense_text(self, text: str) -> str:
+        """Return text as is if it fits the prompt, else a digest of the whole paper."""
+        if len(text) <= MAX_PROMPT_CHARS:
+            return text
+        return digest_text(self.client, text, self.timeout)
+
     def generate_synthesis(self, text: str) -> str:
         """Generate a synthesis of the paper."""
         prompt = """Analyze this research paper and provide a comprehensive synthesis with the following sections:
@@ -113,18 +125,20 @@ Paper text:
 {text}
 """
         try:
-            completion = self.client.chat.completions.create(
+            synthesis = cached_chat_completion(
+                self.client,
+                timeout=self.timeout,
                 model="nvidia/llama-3.1-nemotron-70b-instruct",
                 messages=[{
                     "role": "user",
-                    "content": prompt.format(text=text[:8000])
+                    "content": prompt.format(text=self.condense_text(text))
                 }],
                 temperature=0.3,
                 max_tokens=2048
             )
             
-            if completion.choices:
-                return completion.choices[0].message.content
+            if synthesis is not None:
+                return synthesis
             return "Could not generate synthesis."
             
         except Exception as e:
@@ -173,44 +187,17 @@ Important guidelines:
 5. Keep definitions concise and clear
 
 Text to analyze:
-{text[:8000]}
+{self.condense_text(text)}
 
 Return ONLY the JSON object with no additional text or formatting."""
 
-    def clean_json_response(self, response_text: str) -> dict:
+    def clean_json_response(self, response_text: str, schema=None) -> dict:
         """Clean and parse JSON from API response."""
-        try:
-            # First attempt: direct JSON parsing
-            try:
-                return json.loads(response_text)
-            except json.JSONDecodeError:
-                pass
-
-            # Second attempt: find JSON between curly braces
-            json_match = re.search(r'\{.*\}', response_text, re.DOTALL)
-            if json_match:
-                json_str = json_match.group(0)
-                try:
-                    return json.loads(json_str)
-                except json.JSONDecodeError:
-                    pass
-
-            # Third attempt: clean up common issues and try again
-            cleaned_text = response_text.strip()
-            cleaned_text = re.sub(r'```json\s*', '', cleaned_text)
-            cleaned_text = re.sub(r'```\s*', '', cleaned_text)
-            json_match = re.search(r'\{.*\}', cleaned_text, re.DOTALL)
-            if json_match:
-                json_str = json_match.group(0)
-                json_str = json_str.encode('utf-8').decode('unicode_escape')
-                return json.loads(json_str)
-
+        result = parse_llm_json(response_text, schema)
+        if result is None:
             st.error(f"Could not parse JSON response. Raw response:\n{response_text[:500]}...")
             return {"entities": []}
-
-        except Exception as e:
-            st.error(f"Error cleaning JSON: {str(e)}")
-            return {"entities": []}
+        return result
 
     def extract_entities(self, pdf_file) -> Dict:
         """Extract entities from the PDF."""
@@ -222,7 +209,11 @@ Return ONLY the JSON object with no additional text or formatting."""
         
         with st.spinner("Extracting entities from the paper..."):
             try:
-                completion = self.client.chat.completions.create(
+                response = cached_chat_completion(
+                    self.client,
+                    timeout=self.timeout,
+                    structured_output=self.structured_output,
+                    schema={"entities": list},
                     model="nvidia/llama-3.1-nemotron-70b-instruct",
                     messages=[{
                         "role": "user",
@@ -232,12 +223,11 @@ Return ONLY the JSON object with no additional text or formatting."""
                     max_tokens=2048
                 )
                 
-                if not completion.choices:
+                if response is None:
                     st.error("No response received from API")
                     return {}
                     
-                response = completion.choices[0].message.content
-                return self.clean_json_response(response)
+                return self.clean_json_response(response, {"entities": list})
                 
             except Exception as e:
                 st.error(f"Error extracting entities: {str(e)}")
@@ -272,7 +262,11 @@ Direction guidelines:
         """Extract relationships between entities."""
         with st.spinner("Extracting relationships between entities..."):
             try:
-                completion = self.client.chat.completions.create(
+                response = cached_chat_completion(
+                    self.client,
+                    timeout=self.timeout,
+                    structured_output=self.structured_output,
+                    schema={"relationships": list},
                     model="nvidia/llama-3.1-nemotron-70b-instruct",
                     messages=[{
                         "role": "user",
@@ -282,12 +276,11 @@ Direction guidelines:
                     max_tokens=2048
                 )
                 
-                if not completion.choices:
+                if response is None:
                     st.error("No response received from API")
                     return {}
                     
-                response = completion.choices[0].message.content
-                return self.clean_json_response(response)
+                return self.clean_json_response(response, {"relationships": list})
                 
             except Exception as e:
                 st.error(f"Error extracting relationships: {str(e)}")
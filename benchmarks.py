@@ -0,0 +1,815 @@
+import difflib
+import json
+import os
+import re
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+import threading
+
+import numpy as np
+from PIL import Image
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+from ocr import (
+    compute_iou,
+    count_pdf_pages,
+    create_mask_for_regions,
+    detect_layouts,
+    extract_text_from_layer,
+    get_block_type,
+    get_layout_model,
+    is_text_layer_usable,
+    process_page,
+    process_pdf,
+    read_text_layer,
+    render_pdf_page,
+    whiteout_regions,
+)
+from llm_cache import get_response_cache
+from llm_client import STRUCTURED_OUTPUT_MODES, create_chat_completion, create_openai_client
+from llm_json import parse_llm_json
+from processor import MEDIA_ANALYSIS_SCHEMA, SYNTHESIS_PLAN_SCHEMA, PaperProcessor
+from retrieval import CHARS_PER_TOKEN, PassageIndex, tokenize
+from synthesis import PaperSynthesizer
+from vision import VisionAnalyzer
+
+
+def character_accuracy(reference, hypothesis):
+    """Similarity of two texts at character level, ignoring whitespace layout"""
+    reference = ' '.join(reference.split())
+    hypothesis = ' '.join(hypothesis.split())
+    return difflib.SequenceMatcher(None, reference, hypothesis, autojunk=False).ratio()
+
+
+def resident_memory_mb():
+    """Resident memory of this process in MB, if psutil is installed"""
+    if psutil is None:
+        return None
+    return psutil.Process().memory_info().rss / 2 ** 20
+
+
+def layout_boxes(layout, block_types=('Table', 'Figure')):
+    """Get (type, coords) of the blocks of interest in a detected layout"""
+    return [
+        (get_block_type(block), [float(c) for c in block.coordinates])
+        for block in layout
+        if get_block_type(block) in block_types
+    ]
+
+
+def match_boxes(reference, candidates, iou_threshold=0.5):
+    """Count reference boxes matched one-to-one by a candidate box of the same type"""
+    unmatched = list(candidates)
+    matched = 0
+    for block_type, coords in reference:
+        best = max(
+            (c for c in unmatched if c[0] == block_type),
+            key=lambda c: compute_iou(coords, c[1]),
+            default=None
+        )
+        if best and compute_iou(coords, best[1]) >= iou_threshold:
+            unmatched.remove(best)
+            matched += 1
+    return matched
+
+
+def benchmark_workers(pdf_path, max_workers=None):
+    """Measure OCR pages/second for 1 up to max_workers worker processes"""
+    max_workers = int(max_workers) if max_workers else os.cpu_count()
+    page_count = count_pdf_pages(pdf_path)
+    
+    worker_counts = [1]
+    while worker_counts[-1] * 2 <= max_workers:
+        worker_counts.append(worker_counts[-1] * 2)
+    if worker_counts[-1] != max_workers:
+        worker_counts.append(max_workers)
+    
+    timings = {}
+    for workers in worker_counts:
+        with tempfile.TemporaryDirectory() as output_folder:
+            start = time.perf_counter()
+            process_pdf(pdf_path, output_folder, workers=workers)
+            timings[workers] = time.perf_counter() - start
+    
+    print(f"\n{page_count} pages from {pdf_path}")
+    print(f"{'workers':>8} {'seconds':>9} {'pages/s':>9} {'speedup':>8}")
+    for workers, seconds in timings.items():
+        print(
+            f"{workers:>8} {seconds:>9.2f} {page_count / seconds:>9.2f} "
+            f"{timings[1] / seconds:>7.2f}x"
+        )
+    return timings
+
+
+def benchmark_layout_model(pdf_path, calls=3):
+    """Compare a cold layout model load against warm registry lookups and full runs"""
+    calls = int(calls)
+    lookup_times = []
+    for _ in range(calls):
+        start = time.perf_counter()
+        get_layout_model()
+        lookup_times.append(time.perf_counter() - start)
+    
+    run_times = []
+    for _ in range(2):
+        with tempfile.TemporaryDirectory() as output_folder:
+            start = time.perf_counter()
+            process_pdf(pdf_path, output_folder)
+            run_times.append(time.perf_counter() - start)
+    
+    print(f"\nCold load: {lookup_times[0]:.3f}s")
+    for call, seconds in enumerate(lookup_times[1:], 2):
+        print(f"Warm lookup {call}: {seconds * 1000:.3f}ms")
+    print(f"process_pdf runs on {pdf_path}: " + ", ".join(f"{s:.2f}s" for s in run_times))
+    return lookup_times, run_times
+
+
+def benchmark_ocr_modes(pdf_path, max_pages=5):
+    """Compare full-page and block-level OCR on wall time and accuracy against the PDF text layer"""
+    max_pages = int(max_pages)
+    layout_model = get_layout_model()
+    totals = {'page': [0.0, 0.0], 'blocks': [0.0, 0.0]}
+    pages_measured = 0
+    
+    with tempfile.TemporaryDirectory() as output_folder:
+        output_folder = Path(output_folder)
+        for page_num in range(1, min(count_pdf_pages(pdf_path), max_pages) + 1):
+            text_layer = read_text_layer(pdf_path, page_num)
+            if not is_text_layer_usable(text_layer):
+                print(f"Page {page_num}: no usable text layer to compare against, skipped")
+                continue
+            
+            image_path = output_folder / f'page_{page_num}.png'
+            render_pdf_page(pdf_path, page_num).save(str(image_path))
+            
+            for ocr_mode in totals:
+                start = time.perf_counter()
+                page_result = process_page(image_path, layout_model, output_folder, page_num, ocr_mode=ocr_mode)
+                seconds = time.perf_counter() - start
+                
+                regions = [media['coords'] for media in page_result['tables'] + page_result['figures']]
+                accuracy = character_accuracy(extract_text_from_layer(text_layer, regions), page_result['text'])
+                totals[ocr_mode][0] += seconds
+                totals[ocr_mode][1] += accuracy
+                print(f"Page {page_num} [{ocr_mode}]: {seconds:.2f}s, accuracy {accuracy:.3f}")
+            pages_measured += 1
+    
+    if pages_measured:
+        print(f"\n{'mode':>8} {'s/page':>8} {'accuracy':>9}")
+        for ocr_mode, (seconds, accuracy) in totals.items():
+            print(f"{ocr_mode:>8} {seconds / pages_measured:>8.2f} {accuracy / pages_measured:>9.3f}")
+    return totals
+
+
+def benchmark_layout_dpi(pdf_path, layout_dpi=72, max_pages=5):
+    """Compare render plus layout detection time and table/figure box recall at full and low DPI"""
+    layout_dpi = int(layout_dpi)
+    max_pages = int(max_pages)
+    layout_model = get_layout_model()
+    full_seconds = low_seconds = 0.0
+    reference_count = matched_count = 0
+    pages = min(count_pdf_pages(pdf_path), max_pages)
+    
+    for page_num in range(1, pages + 1):
+        start = time.perf_counter()
+        full_image = render_pdf_page(pdf_path, page_num)
+        full_layout = layout_model.detect(full_image)
+        full_time = time.perf_counter() - start
+        
+        start = time.perf_counter()
+        low_image = render_pdf_page(pdf_path, page_num, layout_dpi)
+        low_layout = layout_model.detect(low_image).scale(full_image.size[0] / low_image.size[0])
+        low_time = time.perf_counter() - start
+        
+        reference = layout_boxes(full_layout)
+        matched = match_boxes(reference, layout_boxes(low_layout))
+        full_seconds += full_time
+        low_seconds += low_time
+        reference_count += len(reference)
+        matched_count += matched
+        print(
+            f"Page {page_num}: {full_time:.2f}s -> {low_time:.2f}s "
+            f"({full_time / low_time:.1f}x), {matched}/{len(reference)} boxes recalled"
+        )
+    
+    recall = matched_count / reference_count if reference_count else 1.0
+    print(f"\nLayout at {layout_dpi} DPI: {full_seconds / low_seconds:.1f}x faster per page, table/figure recall {recall:.3f}")
+    return full_seconds, low_seconds, recall
+
+
+def benchmark_batch_size(pdf_path, max_batch_size=8, pages=16):
+    """Measure layout detection throughput against batch size"""
+    max_batch_size = int(max_batch_size)
+    pages = min(count_pdf_pages(pdf_path), int(pages))
+    layout_model = get_layout_model()
+    images = [render_pdf_page(pdf_path, page_num) for page_num in range(1, pages + 1)]
+    
+    # Warm up so the first measurement does not include lazy initialization
+    detect_layouts(layout_model, images[:1], 1)
+    
+    throughput = {}
+    batch_size = 1
+    while batch_size <= max_batch_size:
+        start = time.perf_counter()
+        detect_layouts(layout_model, images, batch_size)
+        throughput[batch_size] = pages / (time.perf_counter() - start)
+        batch_size *= 2
+    
+    print(f"\nLayout detection on {pages} pages")
+    print(f"{'batch':>6} {'pages/s':>9} {'speedup':>8}")
+    for batch_size, pages_per_second in throughput.items():
+        print(f"{batch_size:>6} {pages_per_second:>9.2f} {pages_per_second / throughput[1]:>7.2f}x")
+    return throughput
+
+
+def benchmark_layout_backends(pdf_folder, candidate='detectron2_int8', reference='detectron2', max_pages=10):
+    """Compare two layout backends on every PDF in a folder
+    
+    Reports per-page latency, memory, and table/figure precision/recall of the
+    candidate against the reference backend, with boxes matched at IoU >= 0.5.
+    """
+    max_pages = int(max_pages)
+    backends = [reference, candidate]
+    models = {}
+    model_memory = {}
+    for backend in backends:
+        before = resident_memory_mb()
+        models[backend] = get_layout_model(backend=backend)
+        after = resident_memory_mb()
+        model_memory[backend] = after - before if before is not None else None
+    
+    latencies = {backend: [] for backend in backends}
+    peak_memory = {backend: 0.0 for backend in backends}
+    reference_count = candidate_count = matched_count = 0
+    
+    for pdf_path in sorted(Path(pdf_folder).glob('*.pdf')):
+        for page_num in range(1, min(count_pdf_pages(pdf_path), max_pages) + 1):
+            image = render_pdf_page(pdf_path, page_num)
+            boxes = {}
+            for backend in backends:
+                start = time.perf_counter()
+                layout = models[backend].detect(image)
+                latencies[backend].append(time.perf_counter() - start)
+                peak_memory[backend] = max(peak_memory[backend], resident_memory_mb() or 0.0)
+                boxes[backend] = layout_boxes(layout)
+            
+            matched = match_boxes(boxes[reference], boxes[candidate])
+            reference_count += len(boxes[reference])
+            candidate_count += len(boxes[candidate])
+            matched_count += matched
+            print(f"{pdf_path.name} page {page_num}: {matched}/{len(boxes[reference])} reference boxes matched")
+    
+    if not latencies[reference]:
+        print(f"No PDF pages found in {pdf_folder}")
+        return None
+    
+    print(f"\n{'backend':>16} {'ms/page':>9} {'p95 ms':>8} {'model MB':>9} {'peak MB':>8}")
+    for backend in backends:
+        page_ms = [seconds * 1000 for seconds in latencies[backend]]
+        p95 = sorted(page_ms)[int(0.95 * (len(page_ms) - 1))]
+        memory = f"{model_memory[backend]:.0f}" if model_memory[backend] is not None else "n/a"
+        peak = f"{peak_memory[backend]:.0f}" if psutil else "n/a"
+        print(f"{backend:>16} {statistics.mean(page_ms):>9.1f} {p95:>8.1f} {memory:>9} {peak:>8}")
+    
+    precision = matched_count / candidate_count if candidate_count else 1.0
+    recall = matched_count / reference_count if reference_count else 1.0
+    print(f"\n{candidate} vs {reference} tables/figures: precision {precision:.3f}, recall {recall:.3f}")
+    return latencies, precision, recall
+
+
+def benchmark_page_handoff(pdf_path, max_pages=5):
+    """Compare the PNG round-trip and mask copy with the in-memory, in-place page path"""
+    max_pages = int(max_pages)
+    timings = {'png_roundtrip': 0.0, 'in_memory': 0.0}
+    peaks = {'png_roundtrip': 0, 'in_memory': 0}
+    
+    with tempfile.TemporaryDirectory() as output_folder:
+        for page_num in range(1, min(count_pdf_pages(pdf_path), max_pages) + 1):
+            rendered = render_pdf_page(pdf_path, page_num)
+            width, height = rendered.size
+            # A table and a figure sized like typical detections
+            regions = [
+                [width // 10, height // 10, width // 2, height // 3],
+                [width // 2, height // 2, width - width // 10, height - height // 10]
+            ]
+            
+            image = rendered.copy()
+            tracemalloc.start()
+            start = time.perf_counter()
+            image_path = Path(output_folder) / f'page_{page_num}.png'
+            image.save(str(image_path))
+            image = Image.open(image_path).convert('RGB')
+            img_array = np.array(image)
+            mask = create_mask_for_regions(image.size, regions)
+            masked_image = img_array.copy()
+            masked_image[mask] = 255
+            Image.fromarray(masked_image)
+            timings['png_roundtrip'] += time.perf_counter() - start
+            peaks['png_roundtrip'] = max(peaks['png_roundtrip'], tracemalloc.get_traced_memory()[1])
+            tracemalloc.stop()
+            
+            image = rendered.copy()
+            tracemalloc.start()
+            start = time.perf_counter()
+            whiteout_regions(image, regions)
+            timings['in_memory'] += time.perf_counter() - start
+            peaks['in_memory'] = max(peaks['in_memory'], tracemalloc.get_traced_memory()[1])
+            tracemalloc.stop()
+    
+    print(f"\n{'path':>14} {'seconds':>9} {'peak traced MB':>15}")
+    for path, seconds in timings.items():
+        print(f"{path:>14} {seconds:>9.3f} {peaks[path] / 2 ** 20:>15.1f}")
+    return timings, peaks
+
+
+def start_stand_in_server(latency=0.5, server_rate_limit=None, response_text="Stand-in description.", token_latency=0.0, json_mode=True):
+    """Start a local chat-completions stand-in that sleeps latency seconds per call
+    
+    With server_rate_limit, requests beyond that many per second get a 429.
+    response_text may be a function of the request's last message content. Tokens
+    are four characters each and take token_latency seconds to generate; streamed
+    requests get one chunk per token. With response_format, only the JSON part of
+    the response is sent, as constrained decoding would produce; with json_mode=False
+    such requests get a 400, as from endpoints without JSON mode.
+    """
+    recent = deque()
+    lock = threading.Lock()
+    
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+            prompt = request.get('messages', [{}])[-1].get('content', '')
+            with lock:
+                now = time.monotonic()
+                while recent and now - recent[0] > 1.0:
+                    recent.popleft()
+                throttled = server_rate_limit is not None and len(recent) >= server_rate_limit
+                if not throttled:
+                    recent.append(now)
+            
+            if throttled:
+                body, status = b'{"error": "rate limited"}', 429
+            elif request.get('response_format') and not json_mode:
+                body, status = b'{"error": {"message": "response_format is not supported"}}', 400
+            else:
+                time.sleep(latency)
+                content = response_text(prompt) if callable(response_text) else response_text
+                if request.get('response_format'):
+                    start = min(p for p in (content.find('{'), content.find('['), len(content)) if p != -1)
+                    content = content[start:max(content.rfind('}'), content.rfind(']')) + 1]
+                tokens = [content[i:i + 4] for i in range(0, len(content), 4)]
+                if request.get('stream'):
+                    self.stream_tokens(tokens)
+                    return
+                time.sleep(token_latency * len(tokens))
+                body = json.dumps({
+                    'choices': [{'message': {'role': 'assistant', 'content': content}}],
+                    'usage': {'prompt_tokens': len(str(prompt)) // 4, 'completion_tokens': len(tokens)}
+                }).encode()
+                status = 200
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        
+        def stream_tokens(self, tokens):
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/event-stream')
+            self.end_headers()
+            try:
+                for token in tokens:
+                    time.sleep(token_latency)
+                    chunk = {
+                        'id': 'stand-in', 'object': 'chat.completion.chunk', 'created': 0, 'model': 'stand-in',
+                        'choices': [{'index': 0, 'delta': {'content': token}, 'finish_reason': None}]
+                    }
+                    self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode())
+                    self.wfile.flush()
+                self.wfile.write(b"data: [DONE]\n\n")
+            except (BrokenPipeError, ConnectionResetError):
+                # The client stopped reading once it had its JSON
+                pass
+        
+        def log_message(self, format, *args):
+            pass
+    
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}/v1/chat/completions"
+
+
+def benchmark_vision_throughput(items=20, requests_per_second=4, latency=0.5, max_workers=8):
+    """Compare sequential and concurrent vision analysis against a local stand-in server"""
+    items = int(items)
+    requests_per_second = float(requests_per_second)
+    latency = float(latency)
+    max_workers = int(max_workers)
+    server, url = start_stand_in_server(latency, server_rate_limit=requests_per_second)
+    # Every item must reach the server, not the response cache
+    cache = get_response_cache()
+    cache_bypass, cache.bypass = cache.bypass, True
+    
+    throughput = {}
+    with tempfile.TemporaryDirectory() as folder:
+        image_path = Path(folder) / 'figure.png'
+        Image.new('RGB', (64, 64), 'white').save(image_path)
+        for workers in (1, max_workers):
+            results_path = Path(folder) / 'results.json'
+            with open(results_path, 'w', encoding='utf-8') as f:
+                json.dump({'pdf_name': 'stand_in', 'pages': [{
+                    'page_num': 1,
+                    'text': 'As shown in Figure 1, the method works.',
+                    'tables': [],
+                    'figures': [{'file_path': str(image_path)} for _ in range(items)]
+                }]}, f)
+            
+            analyzer = VisionAnalyzer("stand-in", requests_per_second, max_in_flight=max_workers)
+            analyzer.invoke_url = url
+            start = time.perf_counter()
+            # The stand-in crops are identical; dedup would send just one of them
+            analyzer.process_results_file(results_path, workers, dedup=False)
+            seconds = time.perf_counter() - start
+            throughput[workers] = (items / seconds, analyzer.rate_limiter.throttled)
+    server.shutdown()
+    cache.bypass = cache_bypass
+    
+    print(f"\n{items} items, {latency}s server latency, limit {requests_per_second} req/s")
+    print(f"{'workers':>8} {'items/s':>9} {'throttled':>10}")
+    for workers, (items_per_second, throttled) in throughput.items():
+        print(f"{workers:>8} {items_per_second:>9.2f} {throttled:>10}")
+    return throughput
+
+
+def stand_in_triage_response(prompt):
+    """Verdicts for every item id in a triage prompt, or one verdict for a single-item prompt"""
+    verdict = {
+        "is_essential": True,
+        "understanding_role": "Shows the main result the text relies on.",
+        "placement_suggestion": "Results section, next to the discussion of the figure."
+    }
+    ids = re.findall(r'^id: (m\d+)$', prompt, re.MULTILINE)
+    if not ids:
+        return json.dumps(verdict, indent=4)
+    return json.dumps([{"id": media_id, **verdict} for media_id in ids], indent=2)
+
+
+def benchmark_media_triage(results_path='results/results_with_descriptions.json', batch_size=8, latency=2.0):
+    """Compare per-item and batched media triage on LLM calls, tokens and wall time
+    
+    Runs against a local stand-in server with a fixed latency per call; tokens are
+    estimated from prompt and response lengths.
+    """
+    batch_size = int(batch_size)
+    latency = float(latency)
+    with open(results_path, 'r', encoding='utf-8') as f:
+        content = json.load(f)
+    server, url = start_stand_in_server(latency, response_text=stand_in_triage_response)
+    cache = get_response_cache()
+    cache_bypass, cache.bypass = cache.bypass, True
+    
+    report = {}
+    for size in (1, batch_size):
+        processor = PaperProcessor("stand-in")
+        processor.client = create_openai_client("stand-in", base_url=url.rsplit('/chat/completions', 1)[0])
+        start = time.perf_counter()
+        # Every item goes to the LLM, so batching is measured on its own
+        analyzed = processor.analyze_all_media(content, batch_size=size, prefilter=False)
+        report[size] = dict(processor.usage, items=len(analyzed), seconds=time.perf_counter() - start)
+    server.shutdown()
+    cache.bypass = cache_bypass
+    
+    print(f"\nMedia triage on {results_path}, {latency}s per call")
+    print(f"{'batch':>6} {'items':>6} {'calls':>6} {'prompt tok':>11} {'output tok':>11} {'seconds':>8}")
+    for size, row in report.items():
+        print(f"{size:>6} {row['items']:>6} {row['calls']:>6} {row['prompt_tokens']:>11} "
+              f"{row['completion_tokens']:>11} {row['seconds']:>8.2f}")
+    return report
+
+
+def benchmark_media_prefilter(results_path='results/results_with_descriptions.json', api_key=None, batch_size=8):
+    """Count LLM triage calls avoided by the local pre-filter and check its verdicts against the LLM
+    
+    Without an api_key the LLM is the local stand-in server, which calls everything
+    essential, so only the call counts are meaningful.
+    """
+    batch_size = int(batch_size)
+    with open(results_path, 'r', encoding='utf-8') as f:
+        content = json.load(f)
+    
+    processor = PaperProcessor(api_key)
+    server = None
+    if api_key is None:
+        server, url = start_stand_in_server(0.0, response_text=stand_in_triage_response)
+        processor.client = create_openai_client("stand-in", base_url=url.rsplit('/chat/completions', 1)[0])
+    
+    items = [
+        item for page in content['pages']
+        for item in page.get('figures', []) + page.get('tables', [])
+    ]
+    decisions = processor.prefilter_all_media(content, items)
+    decided = [(items[p], decision) for p, decision in decisions.items() if items[p].get('description')]
+    llm_results = processor.triage_media_batch([item for item, _ in decided]) if decided else []
+    if server:
+        server.shutdown()
+    
+    agree = sum(
+        1 for (_, decision), result in zip(decided, llm_results)
+        if result and result['analysis'].get('is_essential') == decision['is_essential']
+    )
+    described = sum(1 for item in items if item.get('description'))
+    escalated = sum(1 for p, item in enumerate(items) if p not in decisions and item.get('description'))
+    batches = lambda n: -(-n // batch_size)
+    
+    print(f"\nPre-filter on {results_path}: {len(decisions)} of {len(items)} items decided locally")
+    for item, decision in decided:
+        print(f"  {Path(item['file_path']).name}: {'essential' if decision['is_essential'] else 'non-essential'} "
+              f"({decision['understanding_role']})")
+    print(f"Per-item LLM calls: {described} -> {escalated}")
+    print(f"Batched LLM calls (batch {batch_size}): {batches(described)} -> {batches(escalated)}")
+    if decided:
+        source = "LLM" if api_key else "stand-in LLM"
+        print(f"Agreement with {source} on local verdicts: {agree}/{len(decided)}")
+    return {'decided': len(decisions), 'escalated': escalated, 'agreement': agree / len(decided) if decided else None}
+
+
+def legacy_parse_llm_json(content):
+    """The multi-strategy parser PaperProcessor used before llm_json, without its logging"""
+    try:
+        return json.loads(content)
+    except json.JSONDecodeError:
+        pass
+    if "```" in content:
+        try:
+            content = content.split("```")[1]
+            if content.startswith("json"):
+                content = content[4:].strip()
+            return json.loads(content)
+        except (json.JSONDecodeError, IndexError):
+            pass
+    try:
+        json_match = re.search(r'\{(?:[^{}]|(?R))*\}', content, re.DOTALL)
+        if json_match:
+            try:
+                return json.loads(json_match.group())
+            except json.JSONDecodeError:
+                pass
+    except Exception:
+        pass
+    try:
+        cleaned = content.replace("'", '"')
+        cleaned = re.sub(r'(\w+):', r'"\1":', cleaned)
+        cleaned = re.sub(r',\s*}', '}', cleaned)
+        cleaned = re.sub(r',\s*]', ']', cleaned)
+        match = re.search(r'\{.*\}', cleaned, re.DOTALL)
+        if match:
+            return json.loads(match.group())
+    except Exception:
+        pass
+    return None
+
+
+def sample_llm_responses():
+    """Raw response shapes seen from the synthesis and triage prompts"""
+    plan = {
+        "metadata": {"title": "Autonomous Braking with DQN", "main_objective": "Learn brake timing",
+                     "key_contributions": ["Reward design", "Trauma memory", "Euro NCAP evaluation"]},
+        "synthesis_structure": {
+            "sections": [{
+                "section_id": f"section_{i}",
+                "title": f"Section {i}",
+                "content_plan": {
+                    "key_points": [f"Point {j} of section {i}: see https://arxiv.org/abs/1702.02302" for j in range(5)],
+                    "main_message": "The agent learns when to brake: early enough, not too early.",
+                    "required_context": ["Markov pedestrian model"],
+                    "visual_elements": [{"media_path": f"results/figures/figure_p{i}.png",
+                                         "purpose": "Shows {state, action} pairs", "integration_notes": "Inline"}]
+                }
+            } for i in range(12)],
+            "flow": {"section_sequence": [f"section_{i}" for i in range(12)], "transitions": {}}
+        },
+        "visual_integration": {"essential_visuals": [], "presentation_order": [], "integration_strategy": "inline"}
+    }
+    plan_text = json.dumps(plan, indent=4)
+    verdict = '{"is_essential": true, "understanding_role": "Defines the reward: r = -1 on collision", "placement_suggestion": "Method section"}'
+    return {
+        'plan_clean': plan_text,
+        'plan_fenced': f"Here is the synthesis plan:\n```json\n{plan_text}\n```\nLet me know if you need changes.",
+        'plan_prose': f"Sure! Below is the plan.\n\n{plan_text}\n\nNote: sections follow the paper order.",
+        'plan_trailing_commas': plan_text.replace('"inline"\n    }', '"inline",\n    }').replace(']\n', '],\n', 3),
+        'plan_truncated': plan_text[:int(len(plan_text) * 0.8)],
+        'verdict_clean': verdict,
+        'verdict_prose': f"Analysis: the figure matters.\n{verdict}\nThis concludes the analysis.",
+        'triage_array': "```json\n[" + ", ".join(verdict.replace('{', f'{{"id": "m{i}", ', 1) for i in range(1, 9)) + ",]\n```",
+    }
+
+
+def benchmark_json_parsing(corpus_dir=None, repeat=200):
+    """Compare the legacy and single-pass JSON recovery parsers on raw LLM responses
+    
+    corpus_dir may hold captured raw responses as *.txt files; otherwise built-in
+    samples of the usual response shapes are used.
+    """
+    repeat = int(repeat)
+    if corpus_dir:
+        corpus = {path.stem: path.read_text(encoding='utf-8') for path in sorted(Path(corpus_dir).glob('*.txt'))}
+    else:
+        corpus = sample_llm_responses()
+    
+    print(f"{'response':>22} {'chars':>7} {'legacy ok':>10} {'legacy us':>10} {'new ok':>7} {'new us':>8}")
+    totals = {'legacy': 0.0, 'new': 0.0}
+    for name, text in corpus.items():
+        row = {}
+        for label, parse in (('legacy', legacy_parse_llm_json), ('new', parse_llm_json)):
+            start = time.perf_counter()
+            for _ in range(repeat):
+                value = parse(text)
+            seconds = (time.perf_counter() - start) / repeat
+            totals[label] += seconds
+            row[label] = (value is not None, seconds * 1e6)
+        print(f"{name:>22} {len(text):>7} {str(row['legacy'][0]):>10} {row['legacy'][1]:>10.1f} "
+              f"{str(row['new'][0]):>7} {row['new'][1]:>8.1f}")
+    print(f"Total per pass: legacy {totals['legacy'] * 1e3:.2f} ms, new {totals['new'] * 1e3:.2f} ms")
+    return totals
+
+
+def stand_in_json_responses():
+    """JSON replies with the commentary models tend to add around them, per call type"""
+    commentary = ("\n\nExplanation: the answer above follows the requested structure. "
+                  "Each field was filled from the paper content, and uncertain values were "
+                  "kept brief. Let me know if you would like more detail on any part. ") * 3
+    plan = sample_llm_responses()['plan_clean']
+    return {
+        'media_analysis': (MEDIA_ANALYSIS_SCHEMA, "Here is my analysis:\n" + json.dumps({
+            "is_essential": True,
+            "understanding_role": "Defines the braking reward the rest of the paper optimizes",
+            "placement_suggestion": "Method section"
+        }, indent=4) + commentary),
+        'synthesis_plan': (SYNTHESIS_PLAN_SCHEMA, plan + commentary),
+        'entities': ({"entities": list}, json.dumps({"entities": [
+            {"id": f"entity_{i}", "name": f"Entity {i}", "type": "algorithm",
+             "definition": "A value-based deep RL method.", "domains": ["reinforcement_learning"]}
+            for i in range(10)
+        ]}, indent=4) + commentary),
+        'relationships': ({"relationships": list}, json.dumps({"relationships": [
+            {"source": f"entity_{i}", "target": f"entity_{i + 1}", "type": "improves", "direction": "same"}
+            for i in range(9)
+        ]}, indent=4) + commentary),
+    }
+
+
+def benchmark_structured_output(token_latency=0.01, latency=0.2):
+    """Compare output tokens and latency of plain, JSON-mode and early-stopped streamed calls
+    
+    Runs against the local stand-in server, which generates one four-character token
+    every token_latency seconds and appends commentary after the JSON unless
+    response_format is set.
+    """
+    token_latency = float(token_latency)
+    latency = float(latency)
+    cache = get_response_cache()
+    cache_bypass, cache.bypass = cache.bypass, True
+    
+    print(f"{'call':>16} {'mode':>10} {'out tokens':>11} {'seconds':>8} {'parsed':>7}")
+    report = {}
+    for call_type, (schema, reply) in stand_in_json_responses().items():
+        server, url = start_stand_in_server(latency, response_text=reply, token_latency=token_latency)
+        client = create_openai_client("stand-in", base_url=url.rsplit('/chat/completions', 1)[0])
+        for mode in STRUCTURED_OUTPUT_MODES:
+            start = time.perf_counter()
+            content, usage = create_chat_completion(
+                client, mode, schema,
+                model="stand-in", messages=[{"role": "user", "content": call_type}], max_tokens=4096
+            )
+            seconds = time.perf_counter() - start
+            parsed = parse_llm_json(content, schema) is not None
+            report[(call_type, mode)] = (usage['completion_tokens'], seconds, parsed)
+            print(f"{call_type:>16} {str(mode):>10} {usage['completion_tokens']:>11} {seconds:>8.2f} {str(parsed):>7}")
+        server.shutdown()
+    cache.bypass = cache_bypass
+    return report
+
+
+def stand_in_synthesis_plan(sections=6):
+    """A synthesis plan with the given number of sections and no visuals"""
+    return {
+        "metadata": {"title": "Stand-in paper", "main_objective": "Measure synthesis latency.", "key_contributions": ["None"]},
+        "synthesis_structure": {
+            "sections": [{
+                "section_id": f"s{i}",
+                "title": f"Section {i}",
+                "content_plan": {"key_points": ["A point"], "main_message": "A message", "visual_elements": []}
+            } for i in range(1, sections + 1)],
+            "flow": {"section_sequence": [f"s{i}" for i in range(1, sections + 1)]}
+        }
+    }
+
+
+def benchmark_section_synthesis(sections=6, latency=2.0, max_workers=6):
+    """Compare sequential and concurrent section generation, with and without transition smoothing
+    
+    Runs against a local stand-in server with a fixed latency per call, so wall time
+    is reported in multiples of that latency.
+    """
+    sections = int(sections)
+    latency = float(latency)
+    max_workers = int(max_workers)
+    server, url = start_stand_in_server(latency, response_text="Stand-in section prose.")
+    cache = get_response_cache()
+    cache_bypass, cache.bypass = cache.bypass, True
+    plan = stand_in_synthesis_plan(sections)
+    
+    report = {}
+    for workers, smooth in ((1, False), (max_workers, False), (max_workers, True)):
+        synthesizer = PaperSynthesizer("stand-in", max_workers=workers, smooth_transitions=smooth)
+        synthesizer.client = create_openai_client("stand-in", base_url=url.rsplit('/chat/completions', 1)[0])
+        start = time.perf_counter()
+        synthesis = synthesizer.synthesize_paper(plan, "Stand-in paper content.")
+        seconds = time.perf_counter() - start
+        report[(workers, smooth)] = (seconds, synthesis.count("## Section"))
+    server.shutdown()
+    cache.bypass = cache_bypass
+    
+    print(f"\n{sections} sections, {latency}s per call")
+    print(f"{'workers':>8} {'smoothing':>10} {'sections':>9} {'seconds':>8} {'latencies':>10}")
+    for (workers, smooth), (seconds, written) in report.items():
+        print(f"{workers:>8} {str(smooth):>10} {written:>9} {seconds:>8.2f} {seconds / latency:>10.1f}")
+    return report
+
+
+def benchmark_section_retrieval(results_path='results/results_with_descriptions.json',
+                                plan_path='results/synthesis_plan.json', repeat=100):
+    """Time building the passage index and retrieving each section's context
+    
+    Also compares the text each section prompt carries with the first 3000
+    characters every section used to get, in estimated tokens and in how many of
+    the section's query terms it contains.
+    """
+    repeat = int(repeat)
+    with open(results_path, 'r', encoding='utf-8') as f:
+        pages = json.load(f)['pages']
+    with open(plan_path, 'r', encoding='utf-8') as f:
+        plan = json.load(f)['paper_analysis']['synthesis_plan']
+    
+    start = time.perf_counter()
+    for _ in range(repeat):
+        index = PassageIndex(pages)
+    build_ms = (time.perf_counter() - start) * 1000 / repeat
+    leading_text = " ".join(page.get("text", "") for page in pages)[:3000]
+    
+    def coverage(query, text):
+        terms = set(tokenize(query))
+        return len(terms & set(tokenize(text))) / len(terms) if terms else 0.0
+    
+    postings_kb = (index.rows.nbytes + index.weights.nbytes + index.offsets.nbytes) / 1024
+    print(f"\nIndex: {len(index.passages)} passages, {len(index.vocabulary)} terms, "
+          f"{postings_kb:.0f} KB of postings, built in {build_ms:.2f} ms")
+    print(f"{'section':>30} {'query ms':>9} {'tokens':>7} {'old tokens':>11} {'coverage':>9} {'old coverage':>13}")
+    report = {'build_ms': build_ms, 'postings_kb': postings_kb, 'sections': {}}
+    for section in plan['synthesis_structure']['sections']:
+        start = time.perf_counter()
+        for _ in range(repeat):
+            context = index.section_context(section)
+        query_ms = (time.perf_counter() - start) * 1000 / repeat
+        query = index.section_query(section)
+        row = (query_ms, len(context) // CHARS_PER_TOKEN, len(leading_text) // CHARS_PER_TOKEN,
+               coverage(query, context), coverage(query, leading_text))
+        report['sections'][section['title']] = row
+        print(f"{section['title'][:30]:>30} {row[0]:>9.3f} {row[1]:>7} {row[2]:>11} {row[3]:>9.2f} {row[4]:>13.2f}")
+    return report
+
+
+BENCHMARKS = {
+    'workers': benchmark_workers,
+    'layout_model': benchmark_layout_model,
+    'ocr_modes': benchmark_ocr_modes,
+    'layout_dpi': benchmark_layout_dpi,
+    'batch_size': benchmark_batch_size,
+    'layout_backends': benchmark_layout_backends,
+    'page_handoff': benchmark_page_handoff,
+    'vision_throughput': benchmark_vision_throughput,
+    'media_triage': benchmark_media_triage,
+    'media_prefilter': benchmark_media_prefilter,
+    'json_parsing': benchmark_json_parsing,
+    'structured_output': benchmark_structured_output,
+    'section_synthesis': benchmark_section_synthesis,
+    'section_retrieval': benchmark_section_retrieval,
+}
+
+if __name__ == "__main__":
+    # Example usage: python benchmarks.py workers paper.pdf
+    if len(sys.argv) < 2 or sys.argv[1] not in BENCHMARKS:
+        print(f"Usage: python benchmarks.py [{'|'.join(BENCHMARKS)}] [args...]")
+        sys.exit(1)
+    
+    BENCHMARKS[sys.argv[1]](*sys.argv[2:])
@@ -0,0 +1,109 @@
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional
+
+from llm_cache import cached_chat_completion
+
+# Map step: page-sized chunks, each summarized into a short digest
+CHUNK_CHARS = 6000
+DIGEST_MAX_TOKENS = 300
+DIGEST_MODEL = "nvidia/llama-3.1-nemotron-70b-instruct"
+DIGEST_WORKERS = 8
+
+
+def _split_long(text: str, max_chars: int) -> List[str]:
+    """Split text longer than max_chars at whitespace."""
+    parts = []
+    while len(text) > max_chars:
+        cut = text.rfind(" ", 0, max_chars)
+        cut = cut if cut > max_chars // 2 else max_chars
+        parts.append(text[:cut])
+        text = text[cut:].lstrip()
+    if text:
+        parts.append(text)
+    return parts
+
+
+def chunk_pages(pages: List[Dict], max_chars: int = CHUNK_CHARS) -> List[Dict]:
+    """Group page text into chunks of at most max_chars, breaking at paragraphs.
+
+    Each chunk is {'first_page', 'last_page', 'text'}.
+    """
+    chunks = []
+    current, length, first_page, last_page = [], 0, None, None
+
+    def flush():
+        if current:
+            chunks.append({"first_page": first_page, "last_page": last_page, "text": "\n\n".join(current)})
+
+    for page in pages:
+        for paragraph in page.get("text", "").split("\n\n"):
+            paragraph = " ".join(paragraph.split())
+            for part in _split_long(paragraph, max_chars):
+                if current and length + len(part) > max_chars:
+                    flush()
+                    current, length, first_page = [], 0, None
+                if first_page is None:
+                    first_page = page.get("page_num")
+                current.append(part)
+                length += len(part) + 2
+                last_page = page.get("page_num")
+    flush()
+    return chunks
+
+
+def _chunk_label(chunk: Dict, index: int) -> str:
+    if chunk["first_page"] is None:
+        return f"Part {index}"
+    if chunk["first_page"] == chunk["last_page"]:
+        return f"Page {chunk['first_page']}"
+    return f"Pages {chunk['first_page']}-{chunk['last_page']}"
+
+
+def _digest_prompt(chunk: Dict) -> str:
+    return f'''Summarize this excerpt of a research paper in at most 150 words.
+Keep the problem, methods, key numbers and results, and any figure or table it discusses.
+Return only the summary.
+
+Excerpt:
+{chunk["text"]}'''
+
+
+def summarize_chunk(client, chunk: Dict, timeout: Optional[float] = None) -> str:
+    """Digest one chunk; digests are cached, so re-planning the same paper is cheap."""
+    try:
+        digest = cached_chat_completion(
+            client,
+            timeout=timeout,
+            model=DIGEST_MODEL,
+            messages=[{"role": "user", "content": _digest_prompt(chunk)}],
+            temperature=0.0,
+            max_tokens=DIGEST_MAX_TOKENS
+        )
+    except Exception as e:
+        print(f"Error digesting chunk: {str(e)}")
+        digest = None
+    # Fall back to the start of the chunk rather than losing the pages
+    return digest.strip() if digest else chunk["text"][:600]
+
+
+def digest_pages(client, pages: List[Dict], timeout: Optional[float] = None,
+                 max_workers: int = DIGEST_WORKERS, max_chars: int = CHUNK_CHARS) -> str:
+    """Map-reduce a paper into one digest: summarize chunks in parallel, join them in order."""
+    chunks = chunk_pages(pages, max_chars)
+    if len(chunks) <= 1:
+        # Short papers fit as they are
+        return chunks[0]["text"] if chunks else ""
+
+    print(f"Digesting {len(chunks)} chunks of the paper...")
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        digests = list(executor.map(lambda chunk: summarize_chunk(client, chunk, timeout), chunks))
+
+    return "\n\n".join(
+        f"[{_chunk_label(chunk, i)}] {digest}"
+        for i, (chunk, digest) in enumerate(zip(chunks, digests), 1)
+    )
+
+
+def digest_text(client, text: str, timeout: Optional[float] = None, max_chars: int = CHUNK_CHARS) -> str:
+    """digest_pages for plain text without page structure."""
+    return digest_pages(client, [{"page_num": None, "text": text}], timeout, max_chars=max_chars)
@@ -0,0 +1,158 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from pathlib import Path
+
+from llm_client import create_chat_completion
+
+DEFAULT_CACHE_DIR = Path('.llm_cache')
+DEFAULT_MAX_BYTES = 512 * 2 ** 20
+DEFAULT_TTL_SECONDS = 30 * 24 * 3600
+
+_response_cache = None
+_response_cache_lock = threading.Lock()
+
+
+class ResponseCache:
+    """Content-addressed on-disk cache for LLM and vision responses
+
+    Entries are keyed by a SHA-256 of the full request (model, prompt, sampling
+    parameters and any inline image bytes). Entries older than ttl_seconds are
+    ignored, and the least recently used ones are evicted once the cache grows
+    past max_bytes. With bypass, every lookup misses and nothing is stored.
+    """
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, max_bytes=DEFAULT_MAX_BYTES,
+                 ttl_seconds=DEFAULT_TTL_SECONDS, bypass=False):
+        self.cache_dir = Path(cache_dir)
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self.bypass = bypass
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._size = None
+
+    @staticmethod
+    def key(request, image_bytes=None):
+        """Hash a request dict, plus raw image bytes if the image is not inline"""
+        digest = hashlib.sha256(json.dumps(request, sort_keys=True, ensure_ascii=False).encode('utf-8'))
+        if image_bytes is not None:
+            digest.update(hashlib.sha256(image_bytes).digest())
+        return digest.hexdigest()
+
+    def _path(self, key):
+        return self.cache_dir / key[:2] / f"{key}.json"
+
+    def get(self, key):
+        """Get a cached value, or None on a miss"""
+        if self.bypass:
+            return None
+
+        path = self._path(key)
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                entry = json.load(f)
+        except (OSError, json.JSONDecodeError):
+            entry = None
+
+        if entry is None or time.time() - entry['created'] > self.ttl_seconds:
+            with self._lock:
+                self.misses += 1
+            return None
+
+        # Touch the entry so eviction keeps recently used responses
+        os.utime(path)
+        with self._lock:
+            self.hits += 1
+        return entry['value']
+
+    def set(self, key, value):
+        """Store a value and evict old entries if the cache is over its size budget"""
+        if self.bypass:
+            return
+
+        path = self._path(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        data = json.dumps({'created': time.time(), 'value': value}, ensure_ascii=False).encode('utf-8')
+        tmp_path = path.with_suffix(f".{threading.get_ident()}.tmp")
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+        with self._lock:
+            if self._size is None:
+                self._size = sum(p.stat().st_size for p in self.cache_dir.glob('*/*.json'))
+            else:
+                self._size += len(data)
+            if self._size > self.max_bytes:
+                self._evict()
+
+    def _evict(self):
+        entries = []
+        for p in self.cache_dir.glob('*/*.json'):
+            try:
+                stat = p.stat()
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, p))
+        entries.sort()
+
+        self._size = sum(size for _, size, _ in entries)
+        # Drop least recently used entries down to 90% of the budget
+        for _, size, p in entries:
+            if self._size <= self.max_bytes * 0.9:
+                break
+            try:
+                p.unlink()
+                self._size -= size
+            except OSError:
+                pass
+
+    def stats(self):
+        """Hit/miss counters of this process"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0
+            }
+
+
+def get_response_cache():
+    """Get the process-wide response cache; set LLM_CACHE_BYPASS=1 to bypass it"""
+    global _response_cache
+    with _response_cache_lock:
+        if _response_cache is None:
+            _response_cache = ResponseCache(
+                cache_dir=os.environ.get('LLM_CACHE_DIR', DEFAULT_CACHE_DIR),
+                bypass=os.environ.get('LLM_CACHE_BYPASS') == '1'
+            )
+        return _response_cache
+
+
+def cached_chat_completion(client, timeout=None, cache=None, structured_output=None, schema=None, **request):
+    """Run a chat completion through the response cache and return the message content
+
+    structured_output and schema are passed to llm_client.create_chat_completion for
+    JSON-returning calls. Returns None when the API returns no choices; such
+    responses, and replies cut off at max_tokens, are not cached.
+    """
+    cache = cache or get_response_cache()
+    key = cache.key(request)
+    content = cache.get(key)
+    if content is not None:
+        print("Using cached LLM response")
+        return content
+
+    content, usage = create_chat_completion(client, structured_output, schema, timeout, **request)
+    if content is None:
+        return None
+
+    if usage["finish_reason"] == "length":
+        print("LLM response cut off at max_tokens, not caching it")
+        return content
+    cache.set(key, content)
+    return content
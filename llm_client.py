@@ -0,0 +1,205 @@
+import threading
+import time
+import weakref
+
+import httpx
+from openai import BadRequestError, OpenAI
+
+from llm_json import JSONStreamDetector, parse_llm_json
+
+NVIDIA_BASE_URL = "https://integrate.api.nvidia.com/v1"
+
+# Shared transport limits for every LLM/VLM call in the pipeline
+MAX_CONCURRENCY = 16
+MAX_CONNECTIONS = 32
+MAX_KEEPALIVE_CONNECTIONS = 16
+DEFAULT_TIMEOUT = httpx.Timeout(120.0, connect=10.0)
+
+# structured_output modes for JSON-returning calls
+STRUCTURED_OUTPUT_MODES = (None, 'json_mode', 'stream')
+JSON_OBJECT_FORMAT = {"type": "json_object"}
+
+_transport = None
+_http_client = None
+_http_client_lock = threading.Lock()
+# Clients whose endpoint rejected response_format; their JSON-mode calls stream instead
+_json_mode_unsupported = weakref.WeakSet()
+
+
+class _ReleasingStream(httpx.SyncByteStream):
+    """Response body stream that frees its concurrency slot once the body is closed"""
+    def __init__(self, stream, release):
+        self._stream = stream
+        self._release = release
+        self._released = False
+
+    def __iter__(self):
+        yield from self._stream
+
+    def close(self):
+        try:
+            self._stream.close()
+        finally:
+            if not self._released:
+                self._released = True
+                self._release()
+
+
+class LimitedTransport(httpx.BaseTransport):
+    """Keep-alive connection pool with a global cap on requests in flight
+
+    Callers beyond max_concurrency wait for a slot; the wait is recorded as queueing
+    time next to pool occupancy in metrics().
+    """
+    def __init__(self, max_concurrency=MAX_CONCURRENCY, max_connections=MAX_CONNECTIONS,
+                 max_keepalive_connections=MAX_KEEPALIVE_CONNECTIONS):
+        self._transport = httpx.HTTPTransport(
+            limits=httpx.Limits(
+                max_connections=max_connections,
+                max_keepalive_connections=max_keepalive_connections
+            )
+        )
+        self.max_concurrency = max_concurrency
+        self._slots = threading.BoundedSemaphore(max_concurrency)
+        self._lock = threading.Lock()
+        self._in_flight = 0
+        self._peak_in_flight = 0
+        self._requests = 0
+        self._queue_time = 0.0
+        self._max_queue_time = 0.0
+
+    def _release(self):
+        with self._lock:
+            self._in_flight -= 1
+        self._slots.release()
+
+    def handle_request(self, request):
+        start = time.perf_counter()
+        self._slots.acquire()
+        waited = time.perf_counter() - start
+        with self._lock:
+            self._in_flight += 1
+            self._peak_in_flight = max(self._peak_in_flight, self._in_flight)
+            self._requests += 1
+            self._queue_time += waited
+            self._max_queue_time = max(self._max_queue_time, waited)
+
+        try:
+            response = self._transport.handle_request(request)
+        except Exception:
+            self._release()
+            raise
+
+        # Hold the slot until the body has been read
+        response.stream = _ReleasingStream(response.stream, self._release)
+        return response
+
+    def close(self):
+        self._transport.close()
+
+    def metrics(self):
+        """Snapshot of pool occupancy and queueing time"""
+        pool = getattr(self._transport, '_pool', None)
+        with self._lock:
+            return {
+                'requests': self._requests,
+                'in_flight': self._in_flight,
+                'peak_in_flight': self._peak_in_flight,
+                'max_concurrency': self.max_concurrency,
+                'open_connections': len(pool.connections) if pool is not None else None,
+                'total_queue_seconds': self._queue_time,
+                'max_queue_seconds': self._max_queue_time,
+                'mean_queue_seconds': self._queue_time / self._requests if self._requests else 0.0
+            }
+
+
+def get_http_client():
+    """Get the process-wide pooled HTTP client shared by all LLM and vision calls"""
+    global _transport, _http_client
+    with _http_client_lock:
+        if _http_client is None:
+            _transport = LimitedTransport()
+            _http_client = httpx.Client(transport=_transport, timeout=DEFAULT_TIMEOUT)
+        return _http_client
+
+
+def create_openai_client(api_key, base_url=NVIDIA_BASE_URL):
+    """Create an OpenAI client that sends its requests through the shared pool"""
+    return OpenAI(base_url=base_url, api_key=api_key, http_client=get_http_client())
+
+
+def transport_metrics():
+    """Pool occupancy and queueing metrics of the shared transport"""
+    get_http_client()
+    return _transport.metrics()
+
+
+def stream_until_json(client, schema=None, timeout=None, **request):
+    """Stream a chat completion, closing it once a complete JSON value has arrived
+
+    Returns (content, chunks received, finish reason); the finish reason is 'stop'
+    when the stream was closed early.
+    """
+    detector = JSONStreamDetector()
+    parts = []
+    chunks = 0
+    finish_reason = None
+    stream = client.chat.completions.create(stream=True, timeout=timeout, **request)
+    try:
+        for chunk in stream:
+            if not chunk.choices:
+                continue
+            delta = chunk.choices[0].delta.content or ''
+            chunks += 1
+            parts.append(delta)
+            finish_reason = chunk.choices[0].finish_reason or finish_reason
+            # Anything the model adds after the JSON is never generated
+            if detector.feed(delta) and parse_llm_json(''.join(parts), schema) is not None:
+                finish_reason = 'stop'
+                break
+    finally:
+        stream.close()
+    return ''.join(parts), chunks, finish_reason
+
+
+def create_chat_completion(client, structured_output=None, schema=None, timeout=None, **request):
+    """Run a chat completion expected to return JSON and return (content, usage)
+
+    structured_output='json_mode' asks the endpoint for a JSON object via
+    response_format (array schemas stream instead, as do all later calls on a client
+    whose endpoint rejected response_format); 'stream' streams the reply and
+    stops as soon as a complete top-level value matching schema has arrived.
+    content is None when the API returns no choices. Streamed calls report one
+    completion token per chunk and no prompt tokens. usage also carries the
+    finish_reason; 'length' means the reply was cut off at max_tokens.
+    """
+    if structured_output not in STRUCTURED_OUTPUT_MODES:
+        raise ValueError(f"Unknown structured_output mode: {structured_output}")
+
+    if structured_output == 'json_mode' and (isinstance(schema, list) or client in _json_mode_unsupported):
+        structured_output = 'stream'
+    if structured_output == 'stream':
+        content, chunks, finish_reason = stream_until_json(client, schema, timeout, **request)
+        return content, {"prompt_tokens": 0, "completion_tokens": chunks, "finish_reason": finish_reason}
+
+    try:
+        if structured_output == 'json_mode':
+            response = client.chat.completions.create(
+                timeout=timeout, response_format=JSON_OBJECT_FORMAT, **request
+            )
+        else:
+            response = client.chat.completions.create(timeout=timeout, **request)
+    except BadRequestError as e:
+        if structured_output != 'json_mode':
+            raise
+        print(f"Endpoint rejected JSON mode ({e.status_code}), streaming JSON calls instead")
+        _json_mode_unsupported.add(client)
+        return create_chat_completion(client, 'stream', schema, timeout, **request)
+    usage = {
+        "prompt_tokens": response.usage.prompt_tokens if response.usage else 0,
+        "completion_tokens": response.usage.completion_tokens if response.usage else 0,
+        "finish_reason": response.choices[0].finish_reason if response.choices else None
+    }
+    if not response.choices:
+        return None, usage
+    return response.choices[0].message.content, usage
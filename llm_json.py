@@ -0,0 +1,188 @@
+import json
+import re
+
+CLOSERS = {'{': '}', '[': ']'}
+STRUCTURE_SPECIAL = re.compile(r'[{}\[\]",]')
+STRING_SPECIAL = re.compile(r'["\\\n]')
+
+
+def _scan_json(text, start):
+    """Scan from an opening brace or bracket to its match in one pass
+
+    Tracks strings and escapes so braces inside strings are ignored, drops trailing
+    commas before a closing brace or bracket, and escapes raw newlines inside
+    strings. Returns (repaired candidate, index after it, complete); a truncated
+    candidate is closed off and not complete, and a mismatched closer gives
+    (None, index of the closer, False).
+    """
+    out = []
+    stack = []
+    in_string = False
+    trailing_comma = None
+    last_comma = None
+    pos = start
+
+    while True:
+        # Jump straight to the next character that matters in the current state
+        match = (STRING_SPECIAL if in_string else STRUCTURE_SPECIAL).search(text, pos)
+        end = match.start() if match else len(text)
+        segment = text[pos:end]
+        if segment:
+            out.append(segment)
+            if not in_string and not segment.isspace():
+                trailing_comma = None
+        if match is None:
+            break
+
+        ch = match.group()
+        pos = end + 1
+        if in_string:
+            if ch == '\\':
+                out.append(text[end:end + 2])
+                pos = end + 2
+            elif ch == '"':
+                in_string = False
+                out.append(ch)
+            else:
+                out.append('\\n')
+            continue
+
+        if ch == ',':
+            out.append(ch)
+            trailing_comma = len(out) - 1
+            last_comma = (trailing_comma, stack[:])
+            continue
+
+        if ch == '"':
+            in_string = True
+        elif ch in CLOSERS:
+            stack.append(CLOSERS[ch])
+        else:
+            if not stack or stack.pop() != ch:
+                return None, end, False
+            if trailing_comma is not None:
+                out[trailing_comma] = ''
+        trailing_comma = None
+        out.append(ch)
+        if not stack:
+            return ''.join(out), pos, True
+
+    # Truncated response: close the open string and containers, or else drop the
+    # unfinished last element
+    closed = out + ['"'] if in_string else out[:]
+    if trailing_comma is not None and not in_string:
+        closed[trailing_comma] = ''
+    candidate = ''.join(closed + list(reversed(stack)))
+    if last_comma is not None:
+        try:
+            json.loads(candidate)
+        except json.JSONDecodeError:
+            position, open_stack = last_comma
+            candidate = ''.join(out[:position] + list(reversed(open_stack)))
+    return candidate, len(text), False
+
+
+def _fenced_blocks(text):
+    """Contents of markdown code fences, without their language tag"""
+    blocks = []
+    for block in text.split('```')[1:-1:2]:
+        first_line, _, rest = block.partition('\n')
+        blocks.append(rest if first_line.strip().isalpha() else block)
+    return blocks
+
+
+def matches_schema(value, schema):
+    """Check a parsed value against a minimal schema
+
+    A schema is a type (or tuple of types), a dict of required keys to schemas, or a
+    one-element list whose schema every item must match.
+    """
+    if isinstance(schema, dict):
+        return isinstance(value, dict) and all(
+            key in value and matches_schema(value[key], item_schema)
+            for key, item_schema in schema.items()
+        )
+    if isinstance(schema, list):
+        return isinstance(value, list) and all(matches_schema(item, schema[0]) for item in value)
+    return isinstance(value, schema)
+
+
+def _candidates(text, openers):
+    start = 0
+    while True:
+        positions = [p for p in (text.find(opener, start) for opener in openers) if p != -1]
+        if not positions:
+            return
+        start = min(positions)
+        candidate, end, complete = _scan_json(text, start)
+        if candidate is not None:
+            yield candidate
+        # Resume after a well-formed candidate, or just past a broken or truncated
+        # opener, which may be a stray brace in prose before the real JSON
+        start = end if complete and end > start + 1 else start + 1
+
+
+def parse_llm_json(text, schema=None):
+    """Parse the JSON object or array in a raw LLM response, or return None
+
+    Handles markdown fences, prose around the JSON, trailing commas, raw newlines in
+    strings and truncated output. With schema, the first candidate matching it wins.
+    """
+    if not text:
+        return None
+
+    if isinstance(schema, list):
+        openers = '['
+    elif isinstance(schema, dict):
+        openers = '{'
+    else:
+        openers = '{['
+
+    # Fenced blocks first, then the whole response
+    sources = _fenced_blocks(text) + [text]
+    for source in sources:
+        try:
+            value = json.loads(source)
+            if schema is None or matches_schema(value, schema):
+                return value
+        except json.JSONDecodeError:
+            pass
+
+        for candidate in _candidates(source, openers):
+            try:
+                value = json.loads(candidate)
+            except json.JSONDecodeError:
+                continue
+            if schema is None or matches_schema(value, schema):
+                return value
+
+    return None
+
+
+class JSONStreamDetector:
+    """Tell, chunk by chunk, when a complete top-level JSON object or array has streamed in"""
+    def __init__(self):
+        self.depth = 0
+        self.in_string = False
+        self.escaped = False
+
+    def feed(self, chunk):
+        """Consume a chunk; True once some top-level value has closed"""
+        complete = False
+        for ch in chunk:
+            if self.in_string:
+                if self.escaped:
+                    self.escaped = False
+                elif ch == '\\':
+                    self.escaped = True
+                elif ch == '"':
+                    self.in_string = False
+            elif ch in '{[':
+                self.depth += 1
+            elif ch in '}]' and self.depth:
+                self.depth -= 1
+                complete = complete or self.depth == 0
+            elif ch == '"' and self.depth:
+                # Quotes in prose before the JSON starts are not strings
+                self.in_string = True
+        return complete
@@ -119,12 +119,9 @@ class FigureManager:
             
             for item in media_analysis:
                 if item.get('analysis', {}).get('is_essential', False):
-                    # Extract figure number from path if possible
+                    # Figure number parsed from the caption during OCR
                     path = item['path']
-                    figure_num = None
-                    match = re.search(r'figure_(\d+)', path.lower())
-                    if match:
-                        figure_num = match.group(1)
+                    figure_num = str(item['number']) if item.get('number') is not None else None
                     
                     essential_figures.append({
                         'path': path,
@@ -188,7 +185,7 @@ def display_synthesis_with_figures(synthesis_text: str, essential_figures: list)
                 
                 if figure_num_match:
                     figure_num = figure_num_match.group(1) or figure_num_match.group(2)
-                    if f"figure_{figure_num}" in figure['path'].lower():
+                    if figure['type'] == 'figure' and figure['number'] == figure_num:
                         found_figure = True
                 else:
                     # Try to match by description
@@ -1,4 +1,7 @@
 import cv2
+import csv
+import hashlib
+import io
 import pytesseract
 import layoutparser as lp
 import pdf2image
@@ -6,12 +9,58 @@ import numpy as np
 from PIL import Image, ImageDraw
 import json
 import os
+import re
+import subprocess
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 from pathlib import Path
+import xml.etree.ElementTree as ET
+
+from references import assign_caption_numbers, build_reference_index, parse_caption_label
 
 # Configure Tesseract
 pytesseract.pytesseract.tesseract_cmd = r'C:\Program Files\Tesseract-OCR\tesseract.exe'
 custom_config = r'--psm 1'
 
+# Page segmentation mode per layout block type for block-level OCR
+TEXT_BLOCK_TYPES = ('Text', 'Title', 'List')
+BLOCK_OCR_CONFIGS = {
+    'Text': r'--psm 6',
+    'List': r'--psm 6',
+    'Title': r'--psm 7'
+}
+
+# Table cells: single text line per cell; column gaps must be wider than word spacing
+TABLE_CELL_OCR_CONFIG = r'--psm 7'
+TABLE_MIN_COLUMN_GAP = 0.02
+
+# Caption blocks sit just below a figure or just above a table, within this share of the page height
+CAPTION_MAX_GAP = 0.04
+
+# Pages are rendered at pdf2image's default resolution; the PDF text layer is in points
+RENDER_DPI = 200
+PDF_POINTS_PER_INCH = 72
+
+PUBLAYNET_CONFIG = 'lp://PubLayNet/faster_rcnn_R_50_FPN_3x/config'
+PUBLAYNET_LABEL_MAP = {0: "Text", 1: "Title", 2: "List", 3: "Table", 4: "Figure"}
+
+# Layout backends and their default PubLayNet configs; all produce Text/Title/List/Table/Figure blocks
+LAYOUT_BACKENDS = {
+    'detectron2': PUBLAYNET_CONFIG,
+    'detectron2_int8': PUBLAYNET_CONFIG,
+    'efficientdet': 'lp://PubLayNet/tf_efficientdet_d0/config'
+}
+
+# Process-wide registry of loaded layout models, shared by every caller and Streamlit rerun
+_layout_models = {}
+_layout_model_load_times = {}
+_layout_models_lock = threading.Lock()
+
+# Layout model and artifact writer owned by each parallel page worker process
+_worker_layout_model = None
+_worker_writer = None
+
 def create_mask_for_regions(image_size, regions):
     """Create a boolean mask for regions to ignore"""
     mask = np.zeros(image_size[::-1], dtype=bool)
@@ -27,6 +76,20 @@ def create_mask_for_regions(image_size, regions):
         
     return mask
 
+def whiteout_regions(image, regions, padding=5):
+    """White out regions in place on the page image, without a mask or a copy of the page"""
+    draw = ImageDraw.Draw(image)
+    for coords in regions:
+        x1, y1, x2, y2 = [int(c) for c in coords]
+        # Same padding and bounds as create_mask_for_regions
+        x1 = max(0, x1 - padding)
+        y1 = max(0, y1 - padding)
+        x2 = min(image.size[0], x2 + padding)
+        y2 = min(image.size[1], y2 + padding)
+        if x2 > x1 and y2 > y1:
+            draw.rectangle([x1, y1, x2 - 1, y2 - 1], fill='white')
+    return image
+
 def compute_iou(box1, box2):
     """Compute Intersection over Union between two bounding boxes"""
     x1_1, y1_1, x2_1, y2_1 = box1
@@ -67,8 +130,154 @@ def get_block_type(block):
     
     return 'Unknown'
 
-def process_media_block(block, image, output_folder, page_num, media_type):
-    """Process a table or figure block"""
+class ArtifactWriter:
+    """Bounded background writer for page renders and figure/table crops
+    
+    save() returns immediately with the final path while a thread pool encodes the
+    image; once max_pending images are queued it blocks, so a slow disk applies
+    backpressure to the page loop. flush() waits for every queued write.
+    """
+    FORMATS = {
+        'png': ('PNG', '.png'),
+        'webp': ('WEBP', '.webp'),
+        'jpeg': ('JPEG', '.jpg')
+    }
+
+    def __init__(self, image_format='png', compress_level=6, quality=90, max_workers=2, max_pending=8):
+        if image_format not in self.FORMATS:
+            raise ValueError(f"Unsupported image format '{image_format}', expected one of {list(self.FORMATS)}")
+        self.image_format = image_format
+        self.compress_level = compress_level
+        self.quality = quality
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+        self._pending = threading.BoundedSemaphore(max_pending)
+        self._futures = []
+
+    def _encode(self, image, path):
+        pil_format, _ = self.FORMATS[self.image_format]
+        if self.image_format == 'png':
+            image.save(path, pil_format, compress_level=self.compress_level)
+        elif self.image_format == 'webp':
+            # method=0 is the fastest WebP encoder setting
+            image.save(path, pil_format, quality=self.quality, method=0)
+        else:
+            image.save(path, pil_format, quality=self.quality)
+
+    def save(self, image, path):
+        """Queue an image write and return the path it will have, with this writer's extension"""
+        path = Path(path).with_suffix(self.FORMATS[self.image_format][1])
+        self._pending.acquire()
+        future = self._executor.submit(self._encode, image, path)
+        future.add_done_callback(lambda _: self._pending.release())
+        self._futures.append(future)
+        return path
+
+    def flush(self):
+        """Wait for all queued writes and raise the first failure"""
+        futures, self._futures = self._futures, []
+        for future in futures:
+            future.result()
+
+    def close(self):
+        self.flush()
+        self._executor.shutdown()
+
+def _runs(mask):
+    """(start, end) of each run of True values in a 1-D boolean array"""
+    padded = np.concatenate(([False], mask, [False])).astype(np.int8)
+    edges = np.flatnonzero(np.diff(padded))
+    return list(zip(edges[::2], edges[1::2]))
+
+def _cell_boundaries(line_mask, text_mask, min_gap):
+    """Split one axis at ruling lines and at blank gaps of at least min_gap pixels between text"""
+    boundaries = [(start + end) // 2 for start, end in _runs(line_mask)]
+    text_runs = _runs(text_mask)
+    for (_, end), (start, _) in zip(text_runs, text_runs[1:]):
+        if start - end >= min_gap and not line_mask[end:start].any():
+            boundaries.append((start + end) // 2)
+    
+    boundaries = sorted(set([0, len(text_mask)] + boundaries))
+    # Keep only the intervals that contain text
+    return [
+        (start, end) for start, end in zip(boundaries, boundaries[1:])
+        if text_mask[start:end].any()
+    ]
+
+def detect_table_grid(image):
+    """Find row and column intervals of a table crop from its ruling lines and whitespace
+    
+    Horizontal and vertical rules are isolated with morphological opening. Tables
+    without full rules (e.g. booktabs) fall back to blank gaps between text rows and columns.
+    """
+    gray = cv2.cvtColor(np.array(image.convert('RGB')), cv2.COLOR_RGB2GRAY)
+    binary = cv2.adaptiveThreshold(~gray, 255, cv2.ADAPTIVE_THRESH_MEAN_C, cv2.THRESH_BINARY, 15, -2)
+    height, width = binary.shape
+    
+    horizontal = cv2.morphologyEx(
+        binary, cv2.MORPH_OPEN, cv2.getStructuringElement(cv2.MORPH_RECT, (max(10, width // 4), 1))
+    )
+    vertical = cv2.morphologyEx(
+        binary, cv2.MORPH_OPEN, cv2.getStructuringElement(cv2.MORPH_RECT, (1, max(10, height // 4)))
+    )
+    # Drop the rules, plus a margin for their anti-aliased edges, to leave only text
+    rules = cv2.dilate(cv2.bitwise_or(horizontal, vertical), np.ones((5, 5), np.uint8))
+    text = cv2.bitwise_and(binary, cv2.bitwise_not(rules))
+    
+    rows = _cell_boundaries(horizontal.any(axis=1), text.any(axis=1), min_gap=2)
+    columns = _cell_boundaries(vertical.any(axis=0), text.any(axis=0), min_gap=max(8, int(TABLE_MIN_COLUMN_GAP * width)))
+    return rows, columns, text
+
+def extract_table_structure(image, offset=(0, 0), text_layer=None, max_workers=4):
+    """Read a table crop into a grid of cell strings
+    
+    Cell text comes from the native text layer when usable (offset maps crop pixels
+    to page pixels), otherwise from Tesseract on each non-empty cell.
+    """
+    rows, columns, text = detect_table_grid(image)
+    use_layer = is_text_layer_usable(text_layer)
+    words = [word for block in text_layer for line in block for word in line] if use_layer else []
+    
+    def read_cell(cell):
+        (y1, y2), (x1, x2) = cell
+        if not text[y1:y2, x1:x2].any():
+            return ''
+        if use_layer:
+            box = [x1 + offset[0], y1 + offset[1], x2 + offset[0], y2 + offset[1]]
+            return ' '.join(word['text'] for word in words if is_inside_regions(word['coords'], [box], padding=0))
+        crop = image.crop((max(0, x1 - 2), max(0, y1 - 2), min(image.size[0], x2 + 2), min(image.size[1], y2 + 2)))
+        return pytesseract.image_to_string(crop, config=TABLE_CELL_OCR_CONFIG).strip()
+    
+    cells = [(row, column) for row in rows for column in columns]
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        texts = list(executor.map(read_cell, cells))
+    
+    grid = [texts[i:i + len(columns)] for i in range(0, len(texts), len(columns))] if columns else []
+    # Drop rows and columns where nothing was read
+    grid = [row for row in grid if any(row)]
+    keep = [j for j in range(len(columns)) if any(row[j] for row in grid)]
+    return [[row[j] for j in keep] for row in grid]
+
+def save_table_structure(grid, crop_path):
+    """Write a cell grid as CSV and JSON next to its table crop"""
+    csv_path = Path(crop_path).with_suffix('.csv')
+    json_path = Path(crop_path).with_suffix('.json')
+    with open(csv_path, 'w', encoding='utf-8', newline='') as f:
+        csv.writer(f).writerows(grid)
+    with open(json_path, 'w', encoding='utf-8') as f:
+        json.dump({'cells': grid}, f, ensure_ascii=False, indent=2)
+    
+    return {
+        'rows': len(grid),
+        'columns': len(grid[0]) if grid else 0,
+        'csv_path': str(csv_path),
+        'json_path': str(json_path)
+    }
+
+def process_media_block(block, image, output_folder, page_num, media_type, writer=None, extract_structure=False, text_layer=None):
+    """Process a table or figure block, saving the crop through writer when given
+    
+    With extract_structure, a table's cell grid is also read and saved next to the crop.
+    """
     coords = [int(c) for c in block.coordinates]
     
     # Ensure coordinates are within bounds
@@ -82,17 +291,21 @@ def process_media_block(block, image, output_folder, page_num, media_type):
     if coords[2] <= coords[0] or coords[3] <= coords[1]:
         return None
         
-    # Save media file
+    # Save media file, named by content so crops never overwrite each other
     folder_name = f"{media_type}s"
     save_path = output_folder / folder_name
     save_path.mkdir(parents=True, exist_ok=True)
-    filename = f"{media_type}_{page_num}.png"
+    cropped = image.crop(coords)
+    digest = hashlib.sha1(cropped.tobytes()).hexdigest()[:12]
+    filename = f"{media_type}_p{page_num}_{digest}.png"
     full_path = save_path / filename
     
-    cropped = image.crop(coords)
-    cropped.save(full_path)
+    if writer:
+        full_path = writer.save(cropped, full_path)
+    else:
+        cropped.save(full_path)
     
-    return {
+    media_result = {
         'block': {
             'type': media_type,
             'path': str(full_path),
@@ -102,6 +315,72 @@ def process_media_block(block, image, output_folder, page_num, media_type):
         'coords': coords,
         'file_path': str(full_path)
     }
+    
+    if extract_structure and media_type == 'table':
+        try:
+            grid = extract_table_structure(cropped, coords[:2], text_layer)
+            media_result['structure'] = save_table_structure(grid, full_path)
+        except Exception as e:
+            print(f"Could not extract table structure on page {page_num}: {e}")
+    
+    return media_result
+
+def find_caption_block(coords, layout, media_type, page_size):
+    """Find the text block captioning a table or figure
+    
+    Candidates must overlap the media box horizontally and sit within CAPTION_MAX_GAP
+    of it; blocks below a figure or above a table win ties on distance.
+    """
+    x1, y1, x2, y2 = coords
+    max_gap = CAPTION_MAX_GAP * page_size[1]
+    best = None
+    for block in layout:
+        if get_block_type(block) not in TEXT_BLOCK_TYPES:
+            continue
+        bx1, by1, bx2, by2 = [int(c) for c in block.coordinates]
+        overlap = min(x2, bx2) - max(x1, bx1)
+        if overlap < 0.5 * min(x2 - x1, bx2 - bx1):
+            continue
+        
+        below = by1 - y2
+        above = y1 - by2
+        if -max_gap < below <= max_gap:
+            gap, preferred = max(0, below), media_type == 'figure'
+        elif -max_gap < above <= max_gap:
+            gap, preferred = max(0, above), media_type == 'table'
+        else:
+            continue
+        
+        rank = (gap - (max_gap if preferred else 0), by1)
+        if best is None or rank < best[0]:
+            best = (rank, [max(0, bx1), max(0, by1), min(page_size[0], bx2), min(page_size[1], by2)])
+    
+    return best[1] if best else None
+
+def read_block_text(page, coords, text_layer=None):
+    """Read a block's text from the native text layer, or OCR its crop"""
+    if is_text_layer_usable(text_layer):
+        return ' '.join(
+            word['text'] for block in text_layer for line in block for word in line
+            if is_inside_regions(word['coords'], [coords])
+        )
+    return pytesseract.image_to_string(page.crop(coords), config=BLOCK_OCR_CONFIGS['Text']).strip()
+
+def attach_caption(media_result, layout, page, media_type, text_layer=None):
+    """Pair a table or figure with its caption block and parse its 'Figure N' label"""
+    caption_coords = find_caption_block(media_result['coords'], layout, media_type, page.size)
+    if caption_coords is None:
+        return
+    
+    caption = ' '.join(read_block_text(page, caption_coords, text_layer).split())
+    number, label = parse_caption_label(caption, media_type)
+    if number is None:
+        return
+    
+    media_result['caption'] = caption
+    media_result['caption_coords'] = caption_coords
+    media_result['number'] = number
+    media_result['label'] = label
 
 def process_text(image, confidence_threshold=30):
     """Process text using Tesseract OCR"""
@@ -146,16 +425,171 @@ def process_text(image, confidence_threshold=30):
     
     return text_blocks
 
-def process_page(image_path, layout_model, output_folder, page_num, table_threshold=0.1, figure_threshold=0.9):
-    """Process a single page focusing only on tables and figures, prioritizing tables"""
+def read_text_layer(pdf_path, page_num, dpi=RENDER_DPI):
+    """Read the native text layer of a page as blocks of lines of positioned words, in pixel coordinates"""
+    try:
+        output = subprocess.run(
+            ['pdftotext', '-f', str(page_num), '-l', str(page_num), '-bbox-layout', str(pdf_path), '-'],
+            capture_output=True,
+            check=True
+        ).stdout
+        root = ET.fromstring(output)
+    except (OSError, subprocess.CalledProcessError, ET.ParseError) as e:
+        print(f"Could not read text layer of page {page_num}: {str(e)}")
+        return None
+    
+    scale = dpi / PDF_POINTS_PER_INCH
+    blocks = []
+    for element in root.iter():
+        tag = element.tag.rsplit('}', 1)[-1]
+        if tag == 'block':
+            blocks.append([])
+        elif tag == 'line' and blocks:
+            blocks[-1].append([])
+        elif tag == 'word' and blocks and blocks[-1] and element.text:
+            blocks[-1][-1].append({
+                'text': element.text,
+                'coords': [
+                    float(element.get('xMin')) * scale,
+                    float(element.get('yMin')) * scale,
+                    float(element.get('xMax')) * scale,
+                    float(element.get('yMax')) * scale
+                ]
+            })
+    
+    return blocks
+
+def is_text_layer_usable(text_layer, min_chars=20, min_alnum_ratio=0.6):
+    """Check that a text layer exists and is not garbage (unmapped glyphs, symbol soup)"""
+    if not text_layer:
+        return False
+    
+    text = ''.join(word['text'] for block in text_layer for line in block for word in line)
+    if len(text) < min_chars:
+        return False
+    
+    # Fonts without a unicode map come out as replacement characters or (cid:N) codes
+    if text.count('\ufffd') > len(text) * 0.01 or re.search(r'\(cid:\d+\)', text):
+        return False
+    
+    alnum_chars = sum(c.isalnum() for c in text)
+    return alnum_chars / len(text) >= min_alnum_ratio
+
+def is_inside_regions(coords, regions, padding=5):
+    """Check whether the center of a box falls inside any padded region"""
+    center_x = (coords[0] + coords[2]) / 2
+    center_y = (coords[1] + coords[3]) / 2
+    
+    return any(
+        x1 - padding <= center_x <= x2 + padding and y1 - padding <= center_y <= y2 + padding
+        for x1, y1, x2, y2 in regions
+    )
+
+def extract_text_from_layer(text_layer, regions):
+    """Rebuild page text from the native text layer, dropping words inside table and figure regions"""
+    paragraphs = []
+    for block in text_layer:
+        lines = []
+        for line in block:
+            words = [
+                word['text'] for word in line
+                if not is_inside_regions(word['coords'], regions)
+            ]
+            if words:
+                lines.append(' '.join(words))
+        if lines:
+            paragraphs.append('\n'.join(lines))
+    
+    return '\n\n'.join(paragraphs)
+
+def sort_reading_order(blocks, page_width):
+    """Sort text blocks in two-column reading order, with full-width blocks breaking the columns"""
+    middle = page_width / 2
+    ordered = []
+    columns = []
+    
+    def flush_columns():
+        # Left column top to bottom, then right column
+        columns.sort(key=lambda b: (b['coords'][0] + b['coords'][2] >= page_width, b['coords'][1]))
+        ordered.extend(columns)
+        columns.clear()
+    
+    for block in sorted(blocks, key=lambda b: b['coords'][1]):
+        x1, _, x2, _ = block['coords']
+        if x1 < middle - 0.05 * page_width and x2 > middle + 0.05 * page_width:
+            flush_columns()
+            ordered.append(block)
+        else:
+            columns.append(block)
+    flush_columns()
+    
+    return ordered
+
+def collect_text_blocks(layout, image_size, excluded_regions, text_threshold=0.5):
+    """Collect Text/Title/List blocks outside tables and figures, dropping duplicate detections"""
+    candidates = []
+    for block in layout:
+        block_type = get_block_type(block)
+        score = float(block.score) if hasattr(block, 'score') else 0.8
+        
+        if block_type in TEXT_BLOCK_TYPES and score >= text_threshold:
+            x1, y1, x2, y2 = [int(c) for c in block.coordinates]
+            coords = [max(0, x1), max(0, y1), min(image_size[0], x2), min(image_size[1], y2)]
+            if coords[2] > coords[0] and coords[3] > coords[1] and not is_inside_regions(coords, excluded_regions):
+                candidates.append({'type': block_type, 'coords': coords, 'score': score})
+    
+    # Keep the most confident of overlapping detections
+    text_blocks = []
+    for candidate in sorted(candidates, key=lambda b: b['score'], reverse=True):
+        if all(compute_iou(candidate['coords'], kept['coords']) <= 0.5 for kept in text_blocks):
+            text_blocks.append(candidate)
+    
+    return text_blocks
+
+def ocr_text_blocks(image, text_blocks, max_workers=4):
+    """OCR each text block crop concurrently and stitch the text back in reading order"""
+    def ocr_block(block):
+        x1, y1, x2, y2 = block['coords']
+        crop = image.crop((max(0, x1 - 5), max(0, y1 - 5), min(image.size[0], x2 + 5), min(image.size[1], y2 + 5)))
+        config = BLOCK_OCR_CONFIGS[block['type']]
+        # Wrapped titles span several lines and need block segmentation
+        if block['type'] == 'Title' and y2 - y1 > 0.03 * image.size[1]:
+            config = BLOCK_OCR_CONFIGS['Text']
+        return pytesseract.image_to_string(crop, config=config).strip()
+    
+    ordered_blocks = sort_reading_order(text_blocks, image.size[0])
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        texts = list(executor.map(ocr_block, ordered_blocks))
+    
+    return '\n\n'.join(text for text in texts if text)
+
+def process_page(image_path, layout_model, output_folder, page_num, table_threshold=0.1, figure_threshold=0.9, text_layer=None, ocr_mode='page', text_threshold=0.5, layout=None, writer=None, extract_tables=False):
+    """Process a single page focusing only on tables and figures, prioritizing tables
+    
+    image_path may also be an already decoded PIL image, or a PdfPage, in which case
+    layout detection runs on its layout image and the full-resolution page is only
+    rendered if OCR needs it. Table and figure regions are whited out in place on the
+    page image before full-page OCR. Crops go through the background writer if given.
+    
+    A layout already detected on the layout image (e.g. by detect_layouts) skips detection.
+    
+    When a usable native text layer is given, text comes from it and Tesseract is skipped.
+    Otherwise ocr_mode='page' OCRs the masked page and ocr_mode='blocks' OCRs only the
+    detected Text/Title/List blocks.
+    
+    With extract_tables, each table's cell grid is saved as CSV/JSON next to its crop.
+    """
     print(f"\nProcessing page {page_num}")
     
     try:
-        # Load and check image
-        image = Image.open(image_path)
-        if image.mode != 'RGB':
-            image = image.convert('RGB')
-        img_array = np.array(image)
+        if isinstance(image_path, PdfPage):
+            page = image_path
+        else:
+            # Load and check image
+            image = image_path if isinstance(image_path, Image.Image) else Image.open(image_path)
+            if image.mode != 'RGB':
+                image = image.convert('RGB')
+            page = PdfPage(image)
         
         # Initialize result structure
         page_result = {
@@ -166,8 +600,12 @@ def process_page(image_path, layout_model, output_folder, page_num, table_thresh
         }
         
         # Detect layout
-        print("Detecting tables and figures...")
-        layout = layout_model.detect(image)
+        if layout is None:
+            print("Detecting tables and figures...")
+            layout = layout_model.detect(page.layout_image)
+        if page.layout_scale != 1.0:
+            # Map boxes found on the low-DPI proxy back to full resolution
+            layout = layout.scale(page.layout_scale)
         
         # Collect and process all regions to mask FIRST
         regions_to_mask = []
@@ -183,12 +621,16 @@ def process_page(image_path, layout_model, output_folder, page_num, table_thresh
                 
                 media_result = process_media_block(
                     block, 
-                    image, 
+                    page, 
                     output_folder, 
                     page_num, 
-                    'table'
+                    'table',
+                    writer,
+                    extract_tables,
+                    text_layer
                 )
                 if media_result:
+                    attach_caption(media_result, layout, page, 'table', text_layer)
                     page_result['tables'].append(media_result)
                     
         # Then process figures
@@ -206,36 +648,49 @@ def process_page(image_path, layout_model, output_folder, page_num, table_thresh
                     regions_to_mask.append(coords)
                     media_result = process_media_block(
                         block, 
-                        image, 
+                        page, 
                         output_folder, 
                         page_num, 
-                        'figure'
+                        'figure',
+                        writer
                     )
                     if media_result:
+                        attach_caption(media_result, layout, page, 'figure', text_layer)
                         page_result['figures'].append(media_result)
         
+        if is_text_layer_usable(text_layer):
+            # Born-digital page: read the embedded text, skipping table and figure words
+            print("Extracting text from native text layer")
+            page_result['text'] = extract_text_from_layer(text_layer, regions_to_mask)
+            page_result['text_source'] = 'text_layer'
+        elif ocr_mode == 'blocks':
+            # OCR only the text blocks; tables and figures are never read, so no mask is needed
+            text_blocks = collect_text_blocks(layout, page.size, regions_to_mask, text_threshold)
+            print(f"Running OCR on {len(text_blocks)} text blocks")
+            page_result['text'] = ocr_text_blocks(page.image, text_blocks)
+            page_result['text_source'] = 'ocr_blocks'
         # Create the mask BEFORE any text extraction
-        if regions_to_mask:
+        elif regions_to_mask:
             print(f"Masking {len(regions_to_mask)} regions before text extraction")
-            mask = create_mask_for_regions(image.size, regions_to_mask)
-            masked_image = img_array.copy()
-            masked_image[mask] = 255  # White out masked regions
-            masked_image = Image.fromarray(masked_image)
+            # Crops are already saved, so the page buffer itself can be whited out
+            masked_image = whiteout_regions(page.image, regions_to_mask)
             
             # Extract text ONLY after masking
             page_result['text'] = pytesseract.image_to_string(
                 masked_image,
                 config=custom_config
             )
+            page_result['text_source'] = 'ocr'
         else:
             # If no regions to mask, use original image
             page_result['text'] = pytesseract.image_to_string(
-                image,
+                page.image,
                 config=custom_config
             )
+            page_result['text_source'] = 'ocr'
         
         if regions_to_mask:
-            print(f"Found and masked {len(page_result['tables'])} tables and {len(page_result['figures'])} figures")
+            print(f"Found and excluded {len(page_result['tables'])} tables and {len(page_result['figures'])} figures")
         else:
             print("No tables or figures found on this page")
             
@@ -245,8 +700,327 @@ def process_page(image_path, layout_model, output_folder, page_num, table_thresh
         print(f"Error processing page {page_num}: {str(e)}")
         return None
 
-def process_pdf(pdf_path, output_folder=None, table_threshold=0.1, figure_threshold=0.9):
-    """Process PDF document"""
+def load_layout_model(backend, config_path, score_threshold):
+    """Build a layout model for one of the LAYOUT_BACKENDS
+    
+    detectron2_int8 is the PubLayNet Faster R-CNN with its linear layers dynamically
+    quantized to int8; efficientdet is the much lighter EfficientDet-D0.
+    """
+    if backend == 'efficientdet':
+        # The PubLayNet label map is resolved from the layoutparser catalog
+        return lp.EfficientDetLayoutModel(
+            config_path,
+            extra_config={"output_confidence_threshold": score_threshold},
+            enforce_cpu=True
+        )
+    
+    layout_model = lp.Detectron2LayoutModel(
+        config_path,
+        extra_config=["MODEL.ROI_HEADS.SCORE_THRESH_TEST", score_threshold],
+        label_map=PUBLAYNET_LABEL_MAP
+    )
+    if backend == 'detectron2_int8':
+        import torch
+        layout_model.model.model = torch.quantization.quantize_dynamic(
+            layout_model.model.model,
+            {torch.nn.Linear},
+            dtype=torch.qint8
+        )
+    return layout_model
+
+def get_layout_model(table_threshold=0.1, figure_threshold=0.9, backend='detectron2', config_path=None):
+    """Get a warm layout model, loading it only on first use for this backend, config and threshold"""
+    if backend not in LAYOUT_BACKENDS:
+        raise ValueError(f"Unknown layout backend '{backend}', expected one of {list(LAYOUT_BACKENDS)}")
+    config_path = config_path or LAYOUT_BACKENDS[backend]
+    score_threshold = min(table_threshold, figure_threshold)
+    key = (backend, config_path, score_threshold)
+    
+    with _layout_models_lock:
+        if key in _layout_models:
+            print(f"Reusing warm layout model (loaded in {_layout_model_load_times[key]:.2f}s)")
+            return _layout_models[key]
+        
+        print(f"Loading {backend} layout model {config_path} (score threshold {score_threshold})...")
+        start = time.perf_counter()
+        layout_model = load_layout_model(backend, config_path, score_threshold)
+        load_time = time.perf_counter() - start
+        print(f"Loaded layout model in {load_time:.2f}s")
+        
+        _layout_models[key] = layout_model
+        _layout_model_load_times[key] = load_time
+        return layout_model
+
+def get_layout_model_load_times():
+    """Get the load time in seconds of every model in the registry"""
+    with _layout_models_lock:
+        return dict(_layout_model_load_times)
+
+def detect_layouts(layout_model, images, batch_size=4):
+    """Detect the layouts of several page images, batch_size pages per forward pass
+    
+    Batching needs the Detectron2 predictor; other backends detect page by page.
+    """
+    predictor = getattr(layout_model, 'model', None)
+    if batch_size <= 1 or not hasattr(predictor, 'aug') or not hasattr(layout_model, 'gather_output'):
+        return [layout_model.detect(image) for image in images]
+    
+    import torch
+    layouts = []
+    for start in range(0, len(images), batch_size):
+        inputs = []
+        for image in images[start:start + batch_size]:
+            # Same preprocessing as detectron2's DefaultPredictor, one entry per page
+            original_image = layout_model.image_loader(image)
+            if predictor.input_format == "RGB":
+                original_image = original_image[:, :, ::-1]
+            height, width = original_image.shape[:2]
+            transformed = predictor.aug.get_transform(original_image).apply_image(original_image)
+            inputs.append({
+                'image': torch.as_tensor(transformed.astype("float32").transpose(2, 0, 1)),
+                'height': height,
+                'width': width
+            })
+        
+        with torch.no_grad():
+            outputs = predictor.model(inputs)
+        layouts.extend(layout_model.gather_output(output) for output in outputs)
+    
+    return layouts
+
+def count_pdf_pages(pdf_path):
+    """Get the number of pages without rendering any of them"""
+    return pdf2image.pdfinfo_from_path(pdf_path)['Pages']
+
+def render_pdf_page(pdf_path, page_num, dpi=RENDER_DPI):
+    """Render a single PDF page"""
+    return pdf2image.convert_from_path(
+        pdf_path,
+        dpi=dpi,
+        first_page=page_num,
+        last_page=page_num
+    )[0]
+
+def render_pdf_region(pdf_path, page_num, coords, dpi=RENDER_DPI):
+    """Render only a rectangle of a PDF page, coords given in pixels at dpi"""
+    x1, y1, x2, y2 = [int(c) for c in coords]
+    output = subprocess.run(
+        [
+            'pdftoppm', '-f', str(page_num), '-l', str(page_num), '-r', str(dpi),
+            '-x', str(x1), '-y', str(y1), '-W', str(x2 - x1), '-H', str(y2 - y1),
+            '-singlefile', '-png', str(pdf_path)
+        ],
+        capture_output=True,
+        check=True
+    ).stdout
+    return Image.open(io.BytesIO(output)).convert('RGB')
+
+class PdfPage:
+    """A page image that is rendered at full resolution only when needed
+    
+    Layout detection can run on a low-DPI proxy, while crops are rendered at full
+    resolution region by region unless the full page has already been rendered.
+    """
+    def __init__(self, image=None, pdf_path=None, page_num=None, dpi=RENDER_DPI, layout_image=None, layout_dpi=None):
+        self._image = image
+        self.pdf_path = pdf_path
+        self.page_num = page_num
+        self.dpi = dpi
+        self._layout_image = layout_image
+        self.layout_dpi = layout_dpi
+
+    @property
+    def image(self):
+        """Full-resolution page image, rendered on first access"""
+        if self._image is None:
+            self._image = render_pdf_page(self.pdf_path, self.page_num, self.dpi)
+        return self._image
+
+    @property
+    def layout_image(self):
+        """Image to run layout detection on"""
+        return self._layout_image if self._layout_image is not None else self.image
+
+    @property
+    def layout_scale(self):
+        """Factor from layout image coordinates to full-resolution coordinates"""
+        if self._layout_image is None:
+            return 1.0
+        return self.dpi / self.layout_dpi
+
+    @property
+    def size(self):
+        if self._image is not None:
+            return self._image.size
+        width, height = self._layout_image.size
+        return round(width * self.layout_scale), round(height * self.layout_scale)
+
+    def crop(self, coords):
+        if self._image is not None or self.pdf_path is None:
+            return self.image.crop(coords)
+        return render_pdf_region(self.pdf_path, self.page_num, coords, self.dpi)
+
+def iter_pdf_pages(pdf_path, window_size=1, dpi=RENDER_DPI):
+    """Render PDF pages lazily, at most window_size pages at a time"""
+    page_count = count_pdf_pages(pdf_path)
+    
+    for first_page in range(1, page_count + 1, window_size):
+        last_page = min(first_page + window_size - 1, page_count)
+        images = pdf2image.convert_from_path(
+            pdf_path,
+            dpi=dpi,
+            first_page=first_page,
+            last_page=last_page
+        )
+        for page_num, image in enumerate(images, first_page):
+            yield page_num, image
+        # Drop the window before rendering the next one
+        del images
+
+def prepare_page(pdf_path, page_num, image, output_folder, layout_dpi=None, save_pages=False, writer=None):
+    """Wrap a rendered page for process_page, keeping it in memory
+    
+    With layout_dpi, image is the low-DPI render used for layout detection and the
+    full-resolution page is left unrendered until OCR or crops need it. Page PNGs
+    are only written with save_pages.
+    """
+    if layout_dpi:
+        page = PdfPage(pdf_path=pdf_path, page_num=page_num, layout_image=image, layout_dpi=layout_dpi)
+    else:
+        page = PdfPage(image, pdf_path=pdf_path, page_num=page_num)
+    
+    if save_pages:
+        # Save before processing, which whites out regions on the page image
+        page_path = output_folder / f'page_{page_num}.png'
+        if writer:
+            writer.save(page.image.copy(), page_path)
+        else:
+            page.image.save(str(page_path))
+    return page
+
+def iter_process_pdf(pdf_path, layout_model, output_folder, window_size=1, use_text_layer=True, layout_dpi=None, batch_size=1, save_pages=False, writer=None, **page_options):
+    """Yield page results one by one while the rest of the PDF is still unrendered
+    
+    Layouts are detected batch_size pages at a time; page_options are passed
+    through to process_page. Images written through writer may still be pending
+    until writer.flush().
+    """
+    def process_batch(batch):
+        layouts = detect_layouts(layout_model, [image for _, image in batch], batch_size)
+        for (page_num, image), layout in zip(batch, layouts):
+            page = prepare_page(pdf_path, page_num, image, output_folder, layout_dpi, save_pages, writer)
+            text_layer = read_text_layer(pdf_path, page_num) if use_text_layer else None
+            
+            # Process page
+            page_result = process_page(
+                page,
+                layout_model,
+                output_folder,
+                page_num,
+                text_layer=text_layer,
+                layout=layout,
+                writer=writer,
+                **page_options
+            )
+            if page_result:
+                yield page_result
+    
+    batch = []
+    for page_num, image in iter_pdf_pages(pdf_path, max(window_size, batch_size), layout_dpi or RENDER_DPI):
+        batch.append((page_num, image))
+        if len(batch) == batch_size:
+            yield from process_batch(batch)
+            batch = []
+    if batch:
+        yield from process_batch(batch)
+
+def _init_page_worker(table_threshold, figure_threshold, layout_backend, writer_options):
+    """Load a layout model and start an artifact writer once per worker process"""
+    global _worker_layout_model, _worker_writer
+    
+    # Keep each worker single-threaded so the pool does not oversubscribe cores
+    os.environ['OMP_THREAD_LIMIT'] = '1'
+    import torch
+    torch.set_num_threads(1)
+    
+    _worker_layout_model = get_layout_model(table_threshold, figure_threshold, layout_backend)
+    _worker_writer = ArtifactWriter(**writer_options)
+
+def _process_page_worker(pdf_path, output_folder, page_num, use_text_layer, layout_dpi, save_pages, page_options):
+    """Render and process one page inside a worker process"""
+    image = render_pdf_page(pdf_path, page_num, layout_dpi or RENDER_DPI)
+    page = prepare_page(pdf_path, page_num, image, output_folder, layout_dpi, save_pages, _worker_writer)
+    text_layer = read_text_layer(pdf_path, page_num) if use_text_layer else None
+    
+    page_result = process_page(
+        page,
+        _worker_layout_model,
+        output_folder,
+        page_num,
+        text_layer=text_layer,
+        writer=_worker_writer,
+        **page_options
+    )
+    # Crops must be on disk before the page result is reported
+    _worker_writer.flush()
+    return page_result
+
+def process_pages_parallel(pdf_path, output_folder, table_threshold=0.1, figure_threshold=0.9, workers=2, use_text_layer=True, layout_dpi=None, layout_backend='detectron2', save_pages=False, writer_options=None, **page_options):
+    """Fan pages out over a pool of worker processes and return results in page order"""
+    page_count = count_pdf_pages(pdf_path)
+    page_options = dict(page_options, table_threshold=table_threshold, figure_threshold=figure_threshold)
+    page_results = []
+    
+    with ProcessPoolExecutor(
+        max_workers=workers,
+        initializer=_init_page_worker,
+        initargs=(table_threshold, figure_threshold, layout_backend, writer_options or {})
+    ) as executor:
+        futures = [
+            executor.submit(
+                _process_page_worker,
+                pdf_path,
+                output_folder,
+                page_num,
+                use_text_layer,
+                layout_dpi,
+                save_pages,
+                page_options
+            )
+            for page_num in range(1, page_count + 1)
+        ]
+        for future in as_completed(futures):
+            page_result = future.result()
+            if page_result:
+                print(f"Finished page {page_result['page_num']}/{page_count}")
+                page_results.append(page_result)
+    
+    page_results.sort(key=lambda page: page['page_num'])
+    return page_results
+
+def process_pdf(pdf_path, output_folder=None, table_threshold=0.1, figure_threshold=0.9, window_size=1, workers=1, use_text_layer=True, ocr_mode='page', layout_dpi=None, batch_size=1, layout_backend='detectron2', save_pages=False, image_format='png', compress_level=6, extract_tables=False):
+    """Process PDF document, rendering window_size pages at a time or fanning pages out to workers processes
+    
+    With use_text_layer, born-digital pages take their text from the PDF and only
+    pages without a usable text layer fall back to Tesseract, either on the whole
+    page (ocr_mode='page') or on the detected text blocks (ocr_mode='blocks').
+    
+    With layout_dpi (e.g. 72), layout detection runs on a low-DPI render and the
+    full-resolution page is only rendered for OCR, or region by region for crops.
+    
+    With batch_size > 1, the streaming page loop detects layouts batch_size pages
+    per forward pass.
+    
+    layout_backend picks one of LAYOUT_BACKENDS for table and figure detection.
+    
+    Pages are handed to process_page in memory; page_N.png renders are only
+    written with save_pages. Crops and page renders are encoded on a background
+    writer as image_format ('png', 'webp' or 'jpeg'); compress_level=1 gives fast PNG.
+    
+    With extract_tables, table cell grids are read locally (ruling lines plus per-cell
+    OCR) and saved as CSV/JSON next to the table crops. Off by default: only
+    analyze_paper_media(local_tables=True) uses them.
+    """
     if output_folder is None:
         output_folder = Path('results')
     else:
@@ -256,40 +1030,61 @@ def process_pdf(pdf_path, output_folder=None, table_threshold=0.1, figure_thresh
     # Set poppler path
     os.environ['PATH'] = r"C:\Program Files\poppler\poppler-24.02.0\Library\bin" + os.pathsep + os.environ['PATH']
 
-    # Initialize layout model
-    layout_model = lp.Detectron2LayoutModel(
-        'lp://PubLayNet/faster_rcnn_R_50_FPN_3x/config',
-        extra_config=["MODEL.ROI_HEADS.SCORE_THRESH_TEST", min(table_threshold, figure_threshold)],
-        label_map={0: "Text", 1: "Title", 2: "List", 3: "Table", 4: "Figure"}
-    )
-
     result = {
         'pdf_name': Path(pdf_path).stem,
         'pages': []
     }
+    writer_options = {'image_format': image_format, 'compress_level': compress_level}
 
     try:
-        # Convert PDF to images
-        print("Converting PDF to images...")
-        images = pdf2image.convert_from_path(pdf_path)
-        
-        # Process each page
-        for page_num, image in enumerate(images, 1):
-            # Save page image
-            image_path = output_folder / f'page_{page_num}.png'
-            image.save(str(image_path))
-            
-            # Process page
-            page_result = process_page(
-                image_path,
-                layout_model,
+        if workers > 1:
+            # Each worker renders and processes its own pages
+            print(f"Processing PDF pages with {workers} worker processes...")
+            result['pages'] = process_pages_parallel(
+                pdf_path,
                 output_folder,
-                page_num,
                 table_threshold,
-                figure_threshold
+                figure_threshold,
+                workers,
+                use_text_layer,
+                layout_dpi,
+                layout_backend,
+                save_pages,
+                writer_options,
+                ocr_mode=ocr_mode,
+                extract_tables=extract_tables
             )
-            if page_result:
-                result['pages'].append(page_result)
+        else:
+            # Get the shared layout model
+            layout_model = get_layout_model(table_threshold, figure_threshold, layout_backend)
+            
+            # Render and process pages as a stream
+            print(f"Streaming PDF pages ({window_size} at a time)...")
+            writer = ArtifactWriter(**writer_options)
+            try:
+                for page_result in iter_process_pdf(
+                    pdf_path,
+                    layout_model,
+                    output_folder,
+                    window_size,
+                    use_text_layer,
+                    layout_dpi,
+                    batch_size,
+                    save_pages,
+                    writer,
+                    table_threshold=table_threshold,
+                    figure_threshold=figure_threshold,
+                    ocr_mode=ocr_mode,
+                    extract_tables=extract_tables
+                ):
+                    result['pages'].append(page_result)
+            finally:
+                # Every image must be on disk before results.json points at it
+                writer.close()
+
+        # Index figure/table captions and mentions once for the later stages
+        result['reference_index'] = build_reference_index(result['pages'])
+        assign_caption_numbers(result['pages'], result['reference_index'])
 
         # Save results
         with open(output_folder / 'results.json', 'w', encoding='utf-8') as f:
@@ -300,5 +1095,3 @@ def process_pdf(pdf_path, output_folder=None, table_threshold=0.1, figure_thresh
     except Exception as e:
         print(f"Error processing PDF: {str(e)}")
         return None
-
-
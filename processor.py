@@ -1,16 +1,88 @@
-from openai import OpenAI
 import json
 import time
 from pathlib import Path
 from typing import Dict, List, Optional
 
+from digest import digest_pages
+from llm_cache import get_response_cache
+from llm_client import create_chat_completion, create_openai_client
+from llm_json import parse_llm_json
+from references import assign_caption_numbers, build_reference_index, count_unnumbered_references, media_key
+
+# Batched media triage: per-item prompt budget and output allowance
+MAX_TRIAGE_DESCRIPTION_CHARS = 1200
+MAX_TRIAGE_CONTEXT_CHARS = 400
+TRIAGE_TOKENS_PER_ITEM = 128
+
+# Minimal shapes the code relies on in each structured response
+MEDIA_ANALYSIS_SCHEMA = {"is_essential": bool}
+MEDIA_TRIAGE_SCHEMA = [dict]
+SYNTHESIS_PLAN_SCHEMA = {
+    "metadata": {"title": str, "main_objective": str, "key_contributions": list},
+    "synthesis_structure": {
+        "sections": [{
+            "section_id": str,
+            "title": str,
+            "content_plan": {"key_points": list, "main_message": str, "visual_elements": list}
+        }],
+        "flow": {"section_sequence": list}
+    }
+}
+
+# Local pre-filter thresholds; areas are in pixels of the 200 DPI OCR render
+PREFILTER_MIN_AREA = 150 * 150
+PREFILTER_LARGE_AREA = 400 * 400
+# Below this layout score an item is taken for a false detection. OCR keeps tables
+# from a score of 0.1, so no table is dropped on its score alone.
+PREFILTER_LOW_CONFIDENCE = {"figure": 0.3, "table": 0.1}
+PREFILTER_HIGH_CONFIDENCE = 0.9
+
+
+def prefilter_media(item: Dict, reference_count: int, has_caption: bool,
+                    media_type: str = "figure", citations_complete: bool = True) -> Optional[Dict]:
+    """Decide obvious essential/non-essential media locally; None means ask the LLM.
+
+    reference_count is the number of citations of the item's caption number.
+    citations_complete is False when the text has labels whose number was lost, so
+    an item without citations may still be cited.
+    """
+    x1, y1, x2, y2 = item.get('coords', [0, 0, 0, 0])
+    area = (x2 - x1) * (y2 - y1)
+    confidence = item.get('block', {}).get('confidence', 0.8)
+
+    if confidence < PREFILTER_LOW_CONFIDENCE[media_type]:
+        is_essential, reason = False, f"Low layout confidence ({confidence:.2f}), likely a false detection"
+    elif area < PREFILTER_MIN_AREA:
+        is_essential, reason = False, "Crop too small to carry content (icon, logo or fragment)"
+    elif not has_caption:
+        is_essential, reason = False, "No caption, likely decorative"
+    elif reference_count == 0 and citations_complete:
+        is_essential, reason = False, "Captioned but never cited in the text"
+    elif (reference_count >= 1 and has_caption and confidence >= PREFILTER_HIGH_CONFIDENCE
+          and area >= PREFILTER_LARGE_AREA):
+        is_essential, reason = True, f"Captioned, large and referenced {reference_count} time(s) in the text"
+    else:
+        return None
+
+    return {
+        "is_essential": is_essential,
+        "understanding_role": reason,
+        "placement_suggestion": "Next to the first reference in the text" if is_essential else "N/A",
+        "decided_by": "prefilter"
+    }
+
 class PaperProcessor:
-    def __init__(self, api_key: str = None):
-        """Initialize processor with API key."""
-        self.client = OpenAI(
-            base_url="https://integrate.api.nvidia.com/v1",
-            api_key=api_key or "Your api key here"
-        )
+    def __init__(self, api_key: str = None, timeout: float = 120.0, triage_batch_size: int = 8,
+                 structured_output: Optional[str] = None, map_reduce: bool = True):
+        """Initialize processor with API key, per-call timeout, media triage batch size,
+        structured output mode (None, 'json_mode' or 'stream') and map-reduce planning."""
+        self.client = create_openai_client(api_key or "Your api key here")
+        self.timeout = timeout
+        self.triage_batch_size = triage_batch_size
+        self.structured_output = structured_output
+        self.map_reduce = map_reduce
+        self.usage = {"calls": 0, "prompt_tokens": 0, "completion_tokens": 0}
+        self.prefilter_stats = {}
 
     def _create_llm_analysis_prompt(self, media_type: str, description: str, context: str) -> str:
         """Create analysis prompt for media items."""
@@ -27,6 +99,21 @@ IMPORTANT: Return ONLY the following JSON object with no additional text, no mar
     "placement_suggestion": "brief suggestion where to show this in synthesis"
 }}'''
 
+    def _create_batch_triage_prompt(self, items: List[Dict]) -> str:
+        """Create one triage prompt covering several media items."""
+        entries = "\n\n".join(
+            f'id: {item["id"]}\ntype: {item["type"]}\n'
+            f'Description: {item["description"][:MAX_TRIAGE_DESCRIPTION_CHARS]}\n'
+            f'Context: {item["context"][:MAX_TRIAGE_CONTEXT_CHARS]}'
+            for item in items
+        )
+        return f'''For each visual element of a research paper below, decide if it is essential for understanding the paper.
+
+{entries}
+
+IMPORTANT: Return ONLY a JSON array with one object per id, with no additional text, no markdown, and no explanation:
+[{{"id": "m1", "is_essential": true/false, "understanding_role": "brief reason", "placement_suggestion": "brief placement"}}]'''
+
     def _create_synthesis_prompt(self, paper_text: str, essential_media: List[Dict]) -> str:
         """Create synthesis planning prompt."""
         return f'''Create a structured synthesis plan for this research paper.
@@ -80,81 +167,83 @@ Return ONLY a JSON object with this exact structure:
     }}
 }}'''
 
-    def _call_llm(self, prompt: str, temperature: float = 0.2, max_tokens: int = 1024) -> Optional[Dict]:
-        """Make LLM API call with enhanced error handling and JSON parsing."""
+    def _parse_llm_json(self, content: str, schema=None) -> Optional[Dict]:
+        """Parse JSON from a raw LLM response, validating it against schema if given."""
+        result = parse_llm_json(content, schema)
+        if result is None:
+            print("Could not parse a valid JSON response")
+        return result
+
+    def _call_llm(self, prompt: str, temperature: float = 0.2, max_tokens: int = 1024, schema=None) -> Optional[Dict]:
+        """Make LLM API call with enhanced error handling and JSON parsing.
+        
+        Responses that do not match schema count as failures. Successfully parsed
+        responses are kept in the on-disk response cache, unless they were cut off at
+        max_tokens: the parser can repair those into shorter but valid JSON, which must
+        not outlive this call. The structured_output mode
+        ('json_mode' or 'stream') keeps the model from writing past the JSON.
+        """
         try:
+            request = {
+                "model": "nvidia/llama-3.1-nemotron-70b-instruct",
+                "messages": [{"role": "user", "content": prompt}],
+                "temperature": temperature,
+                "max_tokens": max_tokens,
+                "top_p": 0.8
+            }
+            cache = get_response_cache()
+            cache_key = cache.key(request)
+            if (cached := cache.get(cache_key)) is not None:
+                print("Using cached LLM response")
+                return cached
+            
             print("Sending request to LLM...")
-            response = self.client.chat.completions.create(
-                model="nvidia/llama-3.1-nemotron-70b-instruct",
-                messages=[{"role": "user", "content": prompt}],
-                temperature=temperature,
-                max_tokens=max_tokens,
-                top_p=0.8
+            content, usage = create_chat_completion(
+                self.client, self.structured_output, schema, self.timeout, **request
             )
+            self.usage["calls"] += 1
+            self.usage["prompt_tokens"] += usage["prompt_tokens"]
+            self.usage["completion_tokens"] += usage["completion_tokens"]
             
-            if not response.choices:
+            if content is None:
                 print("No choices in response")
                 return None
                 
-            content = response.choices[0].message.content.strip()
+            content = content.strip()
             print("\nRaw LLM Response:")
             print(content)
             print("\nAttempting to parse JSON...")
             
-            # First attempt: direct JSON parsing
-            try:
-                return json.loads(content)
-            except json.JSONDecodeError as e:
-                print(f"Initial JSON parsing failed: {str(e)}")
-                
-            # Second attempt: clean markdown code blocks
-            if "```" in content:
-                try:
-                    # Extract content between code blocks
-                    content = content.split("```")[1]  # Get content after first ```
-                    if content.startswith("json"):
-                        content = content[4:].strip()  # Remove 'json' marker
-                    return json.loads(content)
-                except (json.JSONDecodeError, IndexError) as e:
-                    print(f"Markdown cleaning attempt failed: {str(e)}")
-            
-            # Third attempt: find JSON-like structure with regex
-            import re
-            try:
-                # Look for content between curly braces, including nested ones
-                pattern = r'\{(?:[^{}]|(?R))*\}'
-                json_match = re.search(pattern, content, re.DOTALL)
-                if json_match:
-                    possible_json = json_match.group()
-                    try:
-                        return json.loads(possible_json)
-                    except json.JSONDecodeError:
-                        print("Found JSON-like structure but parsing failed")
-            except Exception as e:
-                print(f"Regex extraction attempt failed: {str(e)}")
-                
-            # Fourth attempt: aggressive cleaning
-            try:
-                # Replace common formatting issues
-                cleaned = content.replace("'", '"')  # Replace single quotes with double quotes
-                cleaned = re.sub(r'(\w+):', r'"\1":', cleaned)  # Add quotes to keys
-                cleaned = re.sub(r',\s*}', '}', cleaned)  # Remove trailing commas
-                cleaned = re.sub(r',\s*]', ']', cleaned)  # Remove trailing commas in arrays
-                
-                # Find and parse the first JSON-like structure
-                match = re.search(r'\{.*\}', cleaned, re.DOTALL)
-                if match:
-                    return json.loads(match.group())
-            except Exception as e:
-                print(f"Aggressive cleaning attempt failed: {str(e)}")
-            
-            print("All JSON parsing attempts failed")
-            return None
+            result = self._parse_llm_json(content, schema)
+            if usage["finish_reason"] == "length":
+                print("LLM response cut off at max_tokens, not caching it")
+            elif result is not None:
+                cache.set(cache_key, result)
+            return result
             
         except Exception as e:
             print(f"LLM API error: {str(e)}")
             print(f"Full error details: {type(e).__name__}")
             return None
+    @staticmethod
+    def _media_type(item: Dict) -> str:
+        return "figure" if item.get('block', {}).get('type', item.get('type')) == 'figure' else "table"
+
+    def _media_result(self, item: Dict, media_type: str, analysis: Dict) -> Dict:
+        """Build the media analysis entry for an item and its verdict."""
+        return {
+            "type": media_type,
+            "path": item.get('file_path'),
+            "number": item.get('number'),
+            "label": item.get('label'),
+            "content": {
+                "description": item.get('description', ''),
+                "caption": item.get('caption', ''),
+                "reference_text": item.get('reference_text', '')
+            },
+            "analysis": analysis
+        }
+
     def analyze_media_item(self, item: Dict) -> Optional[Dict]:
         """Analyze a single media item."""
         try:
@@ -162,7 +251,7 @@ Return ONLY a JSON object with this exact structure:
                 print(f"Skipping media item: no description available")
                 return None
                 
-            media_type = "figure" if item.get('type') == 'figure' else "table"
+            media_type = self._media_type(item)
             print(f"\nAnalyzing {media_type}...")
             
             prompt = self._create_llm_analysis_prompt(
@@ -171,7 +260,7 @@ Return ONLY a JSON object with this exact structure:
                 item.get('reference_text', '').strip()
             )
             
-            analysis = self._call_llm(prompt)
+            analysis = self._call_llm(prompt, schema=MEDIA_ANALYSIS_SCHEMA)
             if not analysis:
                 print(f"Could not analyze {media_type}, using default analysis")
                 analysis = {
@@ -180,15 +269,7 @@ Return ONLY a JSON object with this exact structure:
                     "placement_suggestion": "N/A"
                 }
                 
-            result = {
-                "type": media_type,
-                "path": item.get('file_path'),
-                "content": {
-                    "description": item.get('description', ''),
-                    "reference_text": item.get('reference_text', '')
-                },
-                "analysis": analysis
-            }
+            result = self._media_result(item, media_type, analysis)
             
             print(f"Successfully analyzed {media_type}")
             return result
@@ -197,22 +278,113 @@ Return ONLY a JSON object with this exact structure:
             print(f"Error analyzing media item: {str(e)}")
             return None
 
-    def analyze_all_media(self, content: Dict) -> List[Dict]:
-        """Analyze all media items in the paper."""
-        analyzed_items = []
-        
+    def triage_media_batch(self, items: List[Dict]) -> List[Optional[Dict]]:
+        """Triage several media items with one LLM call.
+
+        Items whose verdict is missing or malformed fall back to analyze_media_item.
+        """
+        entries = [
+            {
+                "id": f"m{i}",
+                "type": self._media_type(item),
+                "description": " ".join(item['description'].split()),
+                "context": " ".join(item.get('reference_text', '').split())
+            }
+            for i, item in enumerate(items, 1)
+        ]
+        print(f"\nTriaging {len(items)} media items in one call...")
+        response = self._call_llm(
+            self._create_batch_triage_prompt(entries),
+            max_tokens=TRIAGE_TOKENS_PER_ITEM * len(items),
+            schema=MEDIA_TRIAGE_SCHEMA
+        )
+        verdicts = {
+            str(v.get("id")): v for v in response or []
+            if isinstance(v, dict) and isinstance(v.get("is_essential"), bool)
+        }
+
+        results = []
+        for entry, item in zip(entries, items):
+            verdict = verdicts.get(entry["id"])
+            if verdict is None:
+                print(f"No valid verdict for {entry['id']}, analyzing it on its own")
+                results.append(self.analyze_media_item(item))
+                continue
+            analysis = {
+                "is_essential": verdict["is_essential"],
+                "understanding_role": verdict.get("understanding_role", ""),
+                "placement_suggestion": verdict.get("placement_suggestion", "")
+            }
+            results.append(self._media_result(item, entry["type"], analysis))
+        return results
+
+    def prefilter_all_media(self, content: Dict, items: List[Dict]) -> Dict[int, Dict]:
+        """Run the local pre-filter over media items, keyed by position in items."""
+        pages = content.get("pages", [])
+        reference_index = content.get("reference_index") or build_reference_index(pages)
+        # Results from before caption pairing get their numbers from the page captions;
+        # an item left without a caption has no number either
+        assign_caption_numbers(pages, reference_index)
+        unnumbered = count_unnumbered_references(pages)
+
+        decisions = {}
+        for position, item in enumerate(items):
+            media_type = self._media_type(item)
+            entry = {}
+            if 'number' in item:
+                entry = reference_index.get(media_key(media_type, item['number'])) or {}
+            decision = prefilter_media(
+                item,
+                len(entry.get("mentions", [])),
+                bool(item.get('caption')),
+                media_type,
+                unnumbered[media_type] == 0
+            )
+            if decision:
+                decisions[position] = decision
+        return decisions
+
+    def analyze_all_media(self, content: Dict, batch_size: Optional[int] = None, prefilter: bool = True) -> List[Dict]:
+        """Analyze all media items in the paper.
+
+        With prefilter, obvious cases are decided locally and only ambiguous items
+        reach the LLM. Items are triaged batch_size at a time (default:
+        triage_batch_size); batch_size=1 makes one call per item.
+        """
+        batch_size = batch_size or self.triage_batch_size
+        items = []
         for page in content.get("pages", []):
-            # Analyze figures
-            for figure in page.get("figures", []):
-                if analysis := self.analyze_media_item(figure):
-                    analyzed_items.append(analysis)
-                    
-            # Analyze tables
-            for table in page.get("tables", []):
-                if analysis := self.analyze_media_item(table):
-                    analyzed_items.append(analysis)
-        
-        return analyzed_items
+            # Figures, then tables
+            items.extend(page.get("figures", []))
+            items.extend(page.get("tables", []))
+
+        decisions = self.prefilter_all_media(content, items) if prefilter else {}
+        analyzed_items = [None] * len(items)
+        for position, decision in decisions.items():
+            analyzed_items[position] = self._media_result(items[position], self._media_type(items[position]), decision)
+
+        escalated = [
+            position for position, item in enumerate(items)
+            if position not in decisions and item.get('description')
+        ]
+        self.prefilter_stats = {
+            "items": len(items),
+            "decided_locally": len(decisions),
+            "escalated": len(escalated)
+        }
+        if prefilter:
+            print(f"Pre-filter decided {len(decisions)} of {len(items)} media items locally")
+
+        if batch_size <= 1:
+            for position in escalated:
+                analyzed_items[position] = self.analyze_media_item(items[position])
+        else:
+            for start in range(0, len(escalated), batch_size):
+                batch = escalated[start:start + batch_size]
+                for position, result in zip(batch, self.triage_media_batch([items[p] for p in batch])):
+                    analyzed_items[position] = result
+
+        return [analysis for analysis in analyzed_items if analysis]
 
     def create_synthesis_plan(self, content: Dict, analyzed_media: List[Dict]) -> Optional[Dict]:
         """Create synthesis plan using analyzed media."""
@@ -222,14 +394,17 @@ Return ONLY a JSON object with this exact structure:
             if item["analysis"].get("is_essential")
         ]
         
-        # Create synthesis prompt
-        paper_text = " ".join(
-            page.get("text", "") 
-            for page in content.get("pages", [])
-        )[:3000]
+        # Plan from digests of the whole paper, not just its first page
+        if self.map_reduce:
+            paper_text = digest_pages(self.client, content.get("pages", []), timeout=self.timeout)
+        else:
+            paper_text = " ".join(
+                page.get("text", "") 
+                for page in content.get("pages", [])
+            )[:3000]
         
         prompt = self._create_synthesis_prompt(paper_text, essential_media)
-        return self._call_llm(prompt, temperature=0.3, max_tokens=2048)
+        return self._call_llm(prompt, temperature=0.3, max_tokens=2048, schema=SYNTHESIS_PLAN_SCHEMA)
 
     def process_paper(self, content: Dict) -> Optional[Dict]:
         """Process paper and create complete analysis."""
@@ -258,6 +433,7 @@ Return ONLY a JSON object with this exact structure:
                         m for m in analyzed_media 
                         if m["analysis"].get("is_essential")
                     ]),
+                    "prefilter": self.prefilter_stats,
                     "structure_version": "v1"
                 }
             }
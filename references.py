@@ -0,0 +1,185 @@
+import re
+
+# Arabic numbers, or upper-case roman numerals as in IEEE "TABLE IV" (tables only)
+NUMBER = r'(\d+|(?-i:[IVXLC]+)\b)'
+ROMAN_VALUES = {'I': 1, 'V': 5, 'X': 10, 'L': 50, 'C': 100}
+# "Figure 3", "Fig. 3", "Figs. 2-4", "Table [2]", "Tables 1 and 2", "Table II"
+REFERENCE_PATTERN = re.compile(
+    r'\b(Fig(?:ure)?s?|Tables?)\.?\s*[\[(]?\s*' + NUMBER
+    + r'(?:\s*[\])]?\s*(?:[-–]|,|and|&)\s*[\[(]?\s*' + NUMBER + r')?',
+    re.IGNORECASE
+)
+# A capitalised label with no number after it, as left by OCR that drops "[3]" from
+# "Fig. [3]"; lower-case "table" is usually just a word
+UNNUMBERED_REFERENCE_PATTERN = re.compile(
+    r'\b(Fig(?:ure)?s?|FIG(?:URE)?S?|Tables?|TABLES?)\b(?!\.?\s*[\[(]?\s*(?:\d|[IVXLC]+\b))'
+)
+# A paragraph that opens with a label followed by punctuation ("Fig. 3." or
+# "Table 2:"), by a capitalised word ("Fig. 1 Overview", "TABLE I SIMULATION
+# PARAMETERS") or by nothing else is a caption; "Figure 3 shows" is not
+CAPTION_PATTERN = re.compile(
+    r'\s*(Fig(?:ure)?|Table)\.?\s*' + NUMBER + r'(?:\s*[.:|]|\s+(?=(?-i:[A-Z]))|\s*$)',
+    re.IGNORECASE
+)
+PARAGRAPH_PATTERN = re.compile(r'\S(?:[^\n]|\n(?![ \t]*\n))*')
+SENTENCE_END_PATTERN = re.compile(r'[.!?]\s+(?=[A-Z(\[])')
+ABBREVIATIONS = {'fig', 'figs', 'eq', 'eqs', 'e.g', 'i.e', 'al', 'no', 'sec', 'ref', 'vs', 'cf'}
+MAX_CAPTION_CHARS = 600
+MAX_RANGE = 10
+
+
+def media_key(media_type, number):
+    """Index key of a figure or table, e.g. 'figure:3'"""
+    kind = 'table' if media_type.lower().startswith('tab') else 'figure'
+    return f"{kind}:{number}"
+
+
+def label_number(kind, label):
+    """Integer value of a figure/table label, or None for roman numerals on a figure"""
+    if label.isdigit():
+        return int(label)
+    if not kind.lower().startswith('tab'):
+        return None
+    values = [ROMAN_VALUES[ch] for ch in label]
+    return sum(-v if v < next_v else v for v, next_v in zip(values, values[1:] + [0]))
+
+
+def iter_sentences(text, start, end):
+    """Yield (start, end) offsets of the sentences in text[start:end]"""
+    sentence_start = start
+    for match in SENTENCE_END_PATTERN.finditer(text, start, end):
+        words = text[sentence_start:match.start()].split()
+        if words and words[-1].lower() in ABBREVIATIONS:
+            continue
+        yield sentence_start, match.start() + 1
+        sentence_start = match.end()
+    if sentence_start < end:
+        yield sentence_start, end
+
+
+def _referenced_numbers(match):
+    kind = match.group(1)
+    first = label_number(kind, match.group(2))
+    if first is None:
+        return []
+    # "Table 2 and I" pairs a number with a pronoun, not with Table I
+    if match.group(3) is None or match.group(2).isdigit() != match.group(3).isdigit():
+        return [first]
+    last = label_number(kind, match.group(3))
+    separator = match.group(0)[match.end(2) - match.start(0):match.start(3) - match.start(0)]
+    if any(dash in separator for dash in '-–') and first < last <= first + MAX_RANGE:
+        return list(range(first, last + 1))
+    return [first, last]
+
+
+def _span(page_num, text, start, end):
+    return {
+        'page_num': page_num,
+        'start': start,
+        'end': end,
+        'text': ' '.join(text[start:end].split())
+    }
+
+
+def build_reference_index(pages):
+    """Map every figure/table caption and mention in the document to its sentence span
+
+    Returns {'figure:3': {'captions': [...], 'mentions': [...]}, ...}, where each span
+    holds the page number, character offsets into that page's text and the sentence.
+    """
+    index = {}
+    for page in pages:
+        text = page.get('text', '')
+        page_num = page['page_num']
+        for paragraph in PARAGRAPH_PATTERN.finditer(text):
+            caption = CAPTION_PATTERN.match(paragraph.group())
+            number = caption and label_number(caption.group(1), caption.group(2))
+            if number is not None:
+                # A caption is never a mention of its own item
+                entry = index.setdefault(media_key(caption.group(1), number),
+                                         {'captions': [], 'mentions': []})
+                end = min(paragraph.end(), paragraph.start() + MAX_CAPTION_CHARS)
+                entry['captions'].append(_span(page_num, text, paragraph.start(), end))
+                continue
+
+            for start, end in iter_sentences(text, paragraph.start(), paragraph.end()):
+                keys = []
+                for match in REFERENCE_PATTERN.finditer(text, start, end):
+                    keys.extend(media_key(match.group(1), n) for n in _referenced_numbers(match))
+                for key in dict.fromkeys(keys):
+                    entry = index.setdefault(key, {'captions': [], 'mentions': []})
+                    entry['mentions'].append(_span(page_num, text, start, end))
+    return index
+
+
+def count_unnumbered_references(pages):
+    """Figure/table labels in the text without a number, per kind
+    
+    Any of these may be a citation whose number was lost, so a zero mention count
+    in the index does not prove an item is never cited.
+    """
+    counts = {'figure': 0, 'table': 0}
+    for page in pages:
+        for match in UNNUMBERED_REFERENCE_PATTERN.finditer(page.get('text', '')):
+            counts[media_key(match.group(1), 0).split(':')[0]] += 1
+    return counts
+
+
+def parse_caption_label(caption, media_type):
+    """(number, label) of a caption's leading 'Figure N' / 'TABLE II' label, or (None, None)
+    
+    The label keeps the paper's own numbering, e.g. 'Table II' for number 2.
+    """
+    match = CAPTION_PATTERN.match(caption)
+    if match and media_key(match.group(1), 0) == media_key(media_type, 0):
+        number = label_number(match.group(1), match.group(2))
+        if number is not None:
+            return number, f"{media_type.capitalize()} {match.group(2)}"
+    return None, None
+
+
+def assign_caption_numbers(pages, index):
+    """Give media items without a parsed caption the unclaimed captions of their page
+
+    Items and captions are paired in reading order (top to bottom), per media type.
+    """
+    claimed = {
+        media_key(kind, media['number'])
+        for page in pages for kind in ('figure', 'table')
+        for media in page.get(f"{kind}s", []) if 'number' in media
+    }
+    for page in pages:
+        for kind in ('figure', 'table'):
+            unnumbered = sorted(
+                (media for media in page.get(f"{kind}s", []) if 'number' not in media),
+                key=lambda media: (media['coords'][1], media['coords'][0])
+            )
+            captions = sorted(
+                (span['start'], key, span['text'])
+                for key, entry in index.items() if key.startswith(f"{kind}:") and key not in claimed
+                for span in entry['captions'] if span['page_num'] == page['page_num']
+            )
+            for media, (_, key, text) in zip(unnumbered, captions):
+                claimed.add(key)
+                media['caption'] = text
+                media['number'], media['label'] = parse_caption_label(text, kind)
+
+
+def get_reference_context(index, media_type, number, page_num=None, max_chars=500):
+    """Sentences that mention a figure/table, nearest pages first, up to max_chars"""
+    entry = index.get(media_key(media_type, number))
+    if not entry:
+        return ''
+
+    mentions = entry['mentions']
+    if page_num is not None:
+        mentions = sorted(mentions, key=lambda span: (abs(span['page_num'] - page_num), span['page_num'], span['start']))
+
+    context = []
+    length = 0
+    for span in mentions:
+        if length + len(span['text']) > max_chars and context:
+            break
+        context.append(span['text'])
+        length += len(span['text']) + 1
+    return ' '.join(context)[:max_chars]
@@ -0,0 +1,96 @@
+import re
+from collections import Counter
+from typing import Dict, List
+
+import numpy as np
+
+from digest import chunk_pages
+
+# Sections get their top_k best passages within a token budget; passages are sized
+# so that all top_k of them fit
+DEFAULT_TOP_K = 6
+DEFAULT_MAX_TOKENS = 600
+CHARS_PER_TOKEN = 4
+PASSAGE_CHARS = DEFAULT_MAX_TOKENS * CHARS_PER_TOKEN // DEFAULT_TOP_K
+BM25_K1 = 1.5
+BM25_B = 0.75
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+(?:[-'][a-z0-9]+)*")
+STOPWORDS = {
+    'a', 'an', 'and', 'are', 'as', 'at', 'be', 'by', 'for', 'from', 'has', 'have', 'in', 'is',
+    'it', 'its', 'of', 'on', 'or', 'that', 'the', 'their', 'this', 'to', 'was', 'we', 'were',
+    'which', 'with', 'our', 'these', 'can', 'not', 'also', 'how', 'what'
+}
+
+
+def tokenize(text: str) -> List[str]:
+    """Lower-case word tokens without stopwords or single characters."""
+    return [token for token in TOKEN_PATTERN.findall(text.lower())
+            if len(token) > 1 and token not in STOPWORDS]
+
+
+class PassageIndex:
+    """BM25 index over a paper's page text, built once and queried per section
+
+    Scores are stored as postings in CSR layout: for term column c, rows[offsets[c]:offsets[c + 1]]
+    are the passages containing it and weights[...] their BM25 weights, idf included.
+    Memory grows with the text, not with passages x vocabulary.
+    """
+    def __init__(self, pages: List[Dict], passage_chars: int = PASSAGE_CHARS):
+        self.passages = chunk_pages(pages, passage_chars)
+        self.vocabulary = {}
+        rows, columns, frequencies = [], [], []
+        for row, passage in enumerate(self.passages):
+            for term, count in Counter(tokenize(passage["text"])).items():
+                rows.append(row)
+                columns.append(self.vocabulary.setdefault(term, len(self.vocabulary)))
+                frequencies.append(count)
+        rows = np.array(rows, dtype=np.int32)
+        columns = np.array(columns, dtype=np.int32)
+        frequencies = np.array(frequencies, dtype=np.float32)
+
+        lengths = np.bincount(rows, weights=frequencies, minlength=len(self.passages))
+        average_length = max(float(lengths.mean()), 1.0) if len(self.passages) else 1.0
+        document_frequency = np.bincount(columns, minlength=len(self.vocabulary))
+        idf = np.log(1 + (len(self.passages) - document_frequency + 0.5) / (document_frequency + 0.5))
+        weights = idf[columns] * frequencies * (BM25_K1 + 1) / (
+            frequencies + BM25_K1 * (1 - BM25_B + BM25_B * lengths[rows] / average_length)
+        )
+
+        order = np.argsort(columns, kind="stable")
+        self.rows = rows[order]
+        self.weights = weights[order].astype(np.float32)
+        self.offsets = np.concatenate([[0], np.cumsum(document_frequency)])
+
+    def search(self, query: str, top_k: int = DEFAULT_TOP_K) -> List[Dict]:
+        """Best matching passages for query, best first, with their position and score."""
+        columns = [self.vocabulary[term] for term in set(tokenize(query)) if term in self.vocabulary]
+        if not columns:
+            return []
+        # Only the postings of the query terms are touched
+        scores = np.zeros(len(self.passages), dtype=np.float32)
+        for column in columns:
+            start, end = self.offsets[column], self.offsets[column + 1]
+            scores[self.rows[start:end]] += self.weights[start:end]
+        ranked = np.argsort(-scores, kind="stable")[:top_k]
+        return [{**self.passages[i], "index": int(i), "score": float(scores[i])} for i in ranked if scores[i] > 0]
+
+    def section_query(self, section: Dict) -> str:
+        """Query text for a synthesis plan section: its title, key points and main message."""
+        plan = section.get("content_plan", {})
+        return " ".join([section.get("title", "")] + plan.get("key_points", []) + [plan.get("main_message", "")])
+
+    def section_context(self, section: Dict, top_k: int = DEFAULT_TOP_K,
+                        max_tokens: int = DEFAULT_MAX_TOKENS) -> str:
+        """Top passages for a section within max_tokens, in reading order; empty if none match."""
+        budget = max_tokens * CHARS_PER_TOKEN
+        selected = []
+        for passage in self.search(self.section_query(section), top_k):
+            if len(passage["text"]) > budget:
+                continue
+            selected.append(passage)
+            budget -= len(passage["text"])
+
+        selected.sort(key=lambda passage: passage["index"])
+        return "\n\n".join(
+            f"[Page {passage['first_page']}] {passage['text']}" for passage in selected
+        )
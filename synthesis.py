@@ -1,28 +1,52 @@
-from openai import OpenAI
 import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import Dict, List, Optional
+from typing import Callable, Dict, List, Optional, Union
+
+from digest import digest_pages
+from llm_cache import cached_chat_completion
+from llm_client import create_openai_client
+from retrieval import PassageIndex
+
+# Sections are written concurrently, in at most this many calls at once
+SECTION_WORKERS = 6
+TRANSITION_MAX_TOKENS = 120
+MAX_TRANSITION_CONTEXT_CHARS = 600
 
 class PaperSynthesizer:
-    def __init__(self, api_key: str = None):
-        self.client = OpenAI(
-            base_url="https://integrate.api.nvidia.com/v1",
-            api_key=api_key or "Your api key here"
-        )
+    def __init__(self, api_key: str = None, timeout: float = 120.0,
+                 max_workers: int = SECTION_WORKERS, smooth_transitions: bool = False):
+        self.client = create_openai_client(api_key or "Your api key here")
+        self.timeout = timeout
+        self.max_workers = max_workers
+        # Optional second wave of short calls that bridge adjacent sections
+        self.smooth_transitions = smooth_transitions
+
+    def _position_note(self, context: Optional[Dict]) -> str:
+        """Describe where a section sits, since sections are written independently."""
+        if not context:
+            return ""
+        notes = []
+        if context.get("previous_section"):
+            notes.append(f'It follows the section "{context["previous_section"]["title"]}".')
+        else:
+            notes.append("It is the first section.")
+        if context.get("next_section"):
+            notes.append(f'It is followed by the section "{context["next_section"]["title"]}".')
+        else:
+            notes.append("It is the last section.")
+        return "\n" + " ".join(notes) + " Do not repeat what those sections cover.\n"
 
     def _create_section_prompt(self, section: Dict, content: str, visuals: List[Dict]) -> str:
         """Create prompt for synthesizing a section without instructions in output."""
-        # Extract figure numbers for cleaner references
-        visual_refs = []
-        for v in visuals:
-            if path_parts := v.get('path', '').split('_'):
-                if len(path_parts) > 1 and path_parts[1].isdigit():
-                    visual_refs.append(f"{v.get('type', 'Figure')} {path_parts[1]}")
+        # Use the labels parsed from the captions during OCR
+        visual_refs = [v['label'] for v in visuals if v.get('label')]
 
         return f'''I want you to write Section {section["title"]} of a research paper in academic prose.
-
+{self._position_note(section.get("context"))}
 Here is the content to cover:
-{content[:3000]}
+{content}
 
 Main points:
 {json.dumps(section["content_plan"]["key_points"], indent=2)}
@@ -45,7 +69,9 @@ Write this section in academic style, incorporating the available figures natura
             
             # Generate content with stronger system message
             prompt = self._create_section_prompt(section, content, visuals)
-            response = self.client.chat.completions.create(
+            section_text = cached_chat_completion(
+                self.client,
+                timeout=self.timeout,
                 model="nvidia/llama-3.1-nemotron-70b-instruct",
                 messages=[
                     {
@@ -64,9 +90,7 @@ Write this section in academic style, incorporating the available figures natura
                 ],
                 temperature=0.3,
                 max_tokens=1024
-            )
-            
-            section_text = response.choices[0].message.content.strip()
+            ).strip()
             
             # Ensure section starts with header if not present
             if not section_text.startswith('#'):
@@ -78,8 +102,38 @@ Write this section in academic style, incorporating the available figures natura
             print(f"Error generating section {section['title']}: {str(e)}")
             return f"## {section['title']}\nError generating content."
 
-    def synthesize_paper(self, plan: Dict, paper_content: str) -> str:
-        """Generate complete paper synthesis."""
+    def generate_transition(self, previous_text: str, next_text: str) -> str:
+        """Write a one or two sentence bridge between two independently written sections."""
+        prompt = f'''Write one or two sentences of academic prose that lead from the end of one section into the next.
+Return only those sentences.
+
+End of the previous section:
+{previous_text[-MAX_TRANSITION_CONTEXT_CHARS:]}
+
+Start of the next section:
+{next_text[:MAX_TRANSITION_CONTEXT_CHARS]}'''
+        try:
+            transition = cached_chat_completion(
+                self.client,
+                timeout=self.timeout,
+                model="nvidia/llama-3.1-nemotron-70b-instruct",
+                messages=[{"role": "user", "content": prompt}],
+                temperature=0.3,
+                max_tokens=TRANSITION_MAX_TOKENS
+            )
+            return transition.strip() if transition else ""
+        except Exception as e:
+            print(f"Error generating transition: {str(e)}")
+            return ""
+
+    def synthesize_paper(self, plan: Dict, paper_content: Union[str, Callable[[], str]],
+                         index: Optional[PassageIndex] = None) -> str:
+        """Generate complete paper synthesis, writing the sections concurrently.
+
+        With a passage index, each section is written from the passages that match
+        its plan; sections the index finds nothing for fall back to paper_content.
+        paper_content may be a function, called at most once and only when needed.
+        """
         synthesis = []
         
         # Create title and metadata section
@@ -94,26 +148,46 @@ Write this section in academic style, incorporating the available figures natura
         metadata_section.extend(f"- {contrib}" for contrib in metadata["key_contributions"])
         synthesis.append("\n".join(metadata_section))
 
-        # Generate each section
+        # Pass each section its position in the document; sections are written
+        # independently, so this is all they know of their neighbours
         sections = {s["section_id"]: s for s in plan["synthesis_structure"]["sections"]}
-        for i, section_id in enumerate(plan["synthesis_structure"]["flow"]["section_sequence"]):
-            section = sections[section_id]
-            
-            # Pass context about position in document
+        sequence = plan["synthesis_structure"]["flow"]["section_sequence"]
+        ordered = []
+        for i, section_id in enumerate(sequence):
             section_context = {
                 "is_first": i == 0,
-                "is_last": i == len(plan["synthesis_structure"]["flow"]["section_sequence"]) - 1,
-                "previous_section": sections.get(plan["synthesis_structure"]["flow"]["section_sequence"][i-1]) if i > 0 else None,
-                "next_section": sections.get(plan["synthesis_structure"]["flow"]["section_sequence"][i+1]) if i < len(plan["synthesis_structure"]["flow"]["section_sequence"]) - 1 else None
+                "is_last": i == len(sequence) - 1,
+                "previous_section": sections.get(sequence[i-1]) if i > 0 else None,
+                "next_section": sections.get(sequence[i+1]) if i < len(sequence) - 1 else None
             }
-            
-            content = self.generate_section(
-                {**section, "context": section_context},
-                paper_content,
-                plan.get("media_analysis", [])
-            )
-            
-            synthesis.append(content)
+            ordered.append({**sections[section_id], "context": section_context})
+
+        # map keeps the flow order whatever order the calls finish in
+        media_analysis = plan.get("media_analysis", [])
+
+        fallback = {}
+        fallback_lock = threading.Lock()
+
+        def whole_paper():
+            with fallback_lock:
+                if "content" not in fallback:
+                    fallback["content"] = paper_content() if callable(paper_content) else paper_content
+                return fallback["content"]
+
+        def write(section):
+            content = index.section_context(section) if index else ""
+            return self.generate_section(section, content or whole_paper(), media_analysis)
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            texts = list(executor.map(write, ordered))
+            transitions = []
+            if self.smooth_transitions and len(texts) > 1:
+                transitions = list(executor.map(self.generate_transition, texts[:-1], texts[1:]))
+
+        for i, text in enumerate(texts):
+            if i < len(transitions) and transitions[i]:
+                text = f"{text}\n\n{transitions[i]}"
+            synthesis.append(text)
 
         return "\n\n".join(synthesis)
 
@@ -126,7 +200,8 @@ Write this section in academic style, incorporating the available figures natura
 
     
     
-def create_synthesis(plan_path: str, paper_path: str, output_path: Optional[str] = None) -> Optional[str]:
+def create_synthesis(plan_path: str, paper_path: str, output_path: Optional[str] = None,
+                     smooth_transitions: bool = False) -> Optional[str]:
     """Create synthesis from plan and paper content."""
     try:
         # Load and validate files
@@ -145,18 +220,20 @@ def create_synthesis(plan_path: str, paper_path: str, output_path: Optional[str]
                 paper_data = json.load(f)
                 if "pages" not in paper_data:
                     raise ValueError("Invalid paper content structure")
-                paper_content = " ".join(
-                    page.get("text", "").strip() 
-                    for page in paper_data.get("pages", [])
-                    if page.get("text")
-                )
         except Exception as e:
             print(f"Error loading paper content: {str(e)}")
             return None
 
-        # Generate synthesis
-        synthesizer = PaperSynthesizer()
-        synthesis = synthesizer.synthesize_paper(plan_data, paper_content)
+        # Sections are written from the passages retrieved for them. A section whose
+        # plan matches no passage gets the digest of the whole paper, computed on
+        # first use (usually from the planner's cached chunk digests)
+        synthesizer = PaperSynthesizer(smooth_transitions=smooth_transitions)
+        index = PassageIndex(paper_data["pages"])
+        synthesis = synthesizer.synthesize_paper(
+            plan_data,
+            lambda: digest_pages(synthesizer.client, paper_data["pages"], timeout=synthesizer.timeout),
+            index
+        )
 
         # Save output if path provided
         if output_path:
@@ -1,91 +1,316 @@
 import json
-import requests
 import base64
+import io
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
+import threading
 import time
-import re
+
+from PIL import Image
+
+from llm_cache import get_response_cache
+from llm_client import get_http_client
+from references import build_reference_index, get_reference_context, media_key
+
+# Inline images must stay under this many base64 bytes
+MAX_IMAGE_B64_BYTES = 180_000
+IMAGE_MIME_TYPES = {'PNG': 'image/png', 'JPEG': 'image/jpeg', 'WEBP': 'image/webp'}
+
+# Prompt context budget: the caption plus the sentences that cite the item
+MAX_CAPTION_CHARS = 300
+MAX_MENTION_CHARS = 400
+MAX_TABLE_CSV_CHARS = 2000
+
+# Crops whose dHashes differ in at most this many of 64 bits are duplicate candidates;
+# a candidate must also have the same size and nearly the same pixels
+DEFAULT_HASH_DISTANCE = 4
+DUPLICATE_SIZE_TOLERANCE = 2
+DUPLICATE_THUMBNAIL_SIZE = 256
+MAX_DUPLICATE_PIXEL_DIFFERENCE = 4.0
+# Tables with the same layout hash alike whatever their values, so they are never merged
+DEDUP_MEDIA_TYPES = ('Figure',)
+
+class RateLimiter:
+    """Token bucket capping requests/second and requests in flight, with AIMD adaptation
+    
+    Requests are paced at headroom times the configured rate, since pacing at exactly
+    a server's limit still lets timing jitter put one request too many in its window.
+    The rate grows additively after each success, by increase_step (default: a tenth
+    of that rate, so a halved rate recovers in five successes), and is cut
+    multiplicatively whenever the server throttles (429) or fails (5xx).
+    """
+    def __init__(self, requests_per_second=1.0, max_in_flight=4, min_rate=0.1, increase_step=None, decrease_factor=0.5, headroom=0.9):
+        self.max_rate = requests_per_second * headroom
+        self.rate = self.max_rate
+        self.min_rate = min_rate
+        self.increase_step = increase_step if increase_step is not None else self.max_rate / 10
+        self.decrease_factor = decrease_factor
+        self.throttled = 0
+        self._tokens = 1.0
+        self._last_refill = time.monotonic()
+        self._lock = threading.Lock()
+        self._in_flight = threading.BoundedSemaphore(max_in_flight)
+
+    def acquire(self):
+        """Block until a request may start"""
+        self._in_flight.acquire()
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(1.0, self._tokens + (now - self._last_refill) * self.rate)
+                self._last_refill = now
+                if self._tokens >= 1.0:
+                    self._tokens -= 1.0
+                    return
+                wait = (1.0 - self._tokens) / self.rate
+            time.sleep(wait)
+
+    def release(self):
+        self._in_flight.release()
+
+    def on_success(self):
+        with self._lock:
+            self.rate = min(self.max_rate, self.rate + self.increase_step)
+
+    def on_throttle(self):
+        with self._lock:
+            self.rate = max(self.min_rate, self.rate * self.decrease_factor)
+            self.throttled += 1
+
+def perceptual_hash(image_path, hash_size=8):
+    """Difference hash (dHash) of an image as a 64-bit integer"""
+    with Image.open(image_path) as image:
+        pixels = list(image.convert('L').resize((hash_size + 1, hash_size), Image.LANCZOS).getdata())
+
+    value = 0
+    for row in range(hash_size):
+        for col in range(hash_size):
+            left = pixels[row * (hash_size + 1) + col]
+            right = pixels[row * (hash_size + 1) + col + 1]
+            value = (value << 1) | (left > right)
+    return value
+
+
+def hamming_distance(a, b):
+    return bin(a ^ b).count('1')
+
+
+def crop_thumbnail(image_path):
+    """Original size and a grayscale thumbnail of a crop, for confirming duplicates"""
+    with Image.open(image_path) as image:
+        size = image.size
+        thumbnail = image.convert('L')
+        thumbnail.thumbnail((DUPLICATE_THUMBNAIL_SIZE, DUPLICATE_THUMBNAIL_SIZE), Image.LANCZOS)
+        return size, thumbnail
+
+
+def same_crop(a, b):
+    """Whether two (size, thumbnail) pairs show the same image, pixel for pixel within tolerance"""
+    (size_a, thumb_a), (size_b, thumb_b) = a, b
+    if any(abs(x - y) > DUPLICATE_SIZE_TOLERANCE for x, y in zip(size_a, size_b)):
+        return False
+    if thumb_b.size != thumb_a.size:
+        thumb_b = thumb_b.resize(thumb_a.size, Image.LANCZOS)
+    difference = sum(abs(x - y) for x, y in zip(thumb_a.getdata(), thumb_b.getdata()))
+    return difference / (thumb_a.width * thumb_a.height) <= MAX_DUPLICATE_PIXEL_DIFFERENCE
+
+
+def group_duplicate_media(tasks, max_distance=DEFAULT_HASH_DISTANCE):
+    """Group (media, page, media_type, number) tasks whose crops are near-identical
+    
+    A figure joins the first group whose representative hash is within max_distance
+    bits and whose crop has the same size and nearly the same pixels; the first crop
+    of a group is its representative. Tables, and crops that cannot be read, always
+    form a group of their own.
+    """
+    groups = []
+    for task in tasks:
+        media, _, media_type, _ = task
+        if media_type not in DEDUP_MEDIA_TYPES:
+            groups.append((None, None, [task]))
+            continue
+        try:
+            media_hash = perceptual_hash(media['file_path'])
+            crop = crop_thumbnail(media['file_path'])
+        except (OSError, ValueError) as e:
+            print(f"Could not hash {media['file_path']}: {e}")
+            groups.append((None, None, [task]))
+            continue
+
+        media['perceptual_hash'] = f"{media_hash:016x}"
+        for group_hash, group_crop, members in groups:
+            if (group_hash is not None and members[0][2] == media_type
+                    and hamming_distance(group_hash, media_hash) <= max_distance
+                    and same_crop(group_crop, crop)):
+                members.append(task)
+                break
+        else:
+            groups.append((media_hash, crop, [task]))
+    return [members for _, _, members in groups]
+
+
+class ImageEncoder:
+    """Fit crops into the inline image budget and cache the encoded payloads
+    
+    Crops already under the budget are sent as they are, with their real MIME type.
+    Larger ones are re-encoded as JPEG at the largest scale that fits at min_quality
+    and then at the highest quality that fits at that scale, both found by binary search.
+    """
+    def __init__(self, max_b64_bytes=MAX_IMAGE_B64_BYTES, min_quality=40, max_quality=95, min_scale=0.05):
+        self.max_b64_bytes = max_b64_bytes
+        self.min_quality = min_quality
+        self.max_quality = max_quality
+        self.min_scale = min_scale
+        self._cache = {}
+        self._lock = threading.Lock()
+        self.original_bytes = 0
+        self.encoded_bytes = 0
+        self.reencoded = 0
+
+    @staticmethod
+    def _b64_size(num_bytes):
+        return 4 * ((num_bytes + 2) // 3)
+
+    def _encode_jpeg(self, image, scale, quality):
+        if scale < 1.0:
+            size = (max(1, round(image.width * scale)), max(1, round(image.height * scale)))
+            image = image.resize(size, Image.LANCZOS)
+        buffer = io.BytesIO()
+        image.save(buffer, format='JPEG', quality=quality, optimize=True)
+        return buffer.getvalue()
+
+    def _fits(self, data):
+        return self._b64_size(len(data)) < self.max_b64_bytes
+
+    def _fit(self, image):
+        """Largest scale, then highest quality, whose JPEG fits the budget"""
+        data = self._encode_jpeg(image, 1.0, self.min_quality)
+        scale = 1.0
+        if not self._fits(data):
+            low, high = self.min_scale, 1.0
+            data = self._encode_jpeg(image, low, self.min_quality)
+            if not self._fits(data):
+                raise ValueError(f"image does not fit in {self.max_b64_bytes} bytes even at scale {low}")
+            scale = low
+            # Scale to within 2% of the best fit
+            while high - low > 0.02:
+                mid = (low + high) / 2
+                candidate = self._encode_jpeg(image, mid, self.min_quality)
+                if self._fits(candidate):
+                    low, scale, data = mid, mid, candidate
+                else:
+                    high = mid
+
+        low, high = self.min_quality + 1, self.max_quality
+        while low <= high:
+            mid = (low + high) // 2
+            candidate = self._encode_jpeg(image, scale, mid)
+            if self._fits(candidate):
+                data = candidate
+                low = mid + 1
+            else:
+                high = mid - 1
+        return data
+
+    def encode(self, image_path):
+        """Return (base64 payload, MIME type) for a crop"""
+        path = Path(image_path)
+        stat = path.stat()
+        cache_key = (str(path.resolve()), stat.st_mtime_ns, stat.st_size)
+        with self._lock:
+            if cache_key in self._cache:
+                return self._cache[cache_key]
+
+        raw = path.read_bytes()
+        with Image.open(io.BytesIO(raw)) as image:
+            mime_type = IMAGE_MIME_TYPES.get(image.format)
+            if mime_type and self._fits(raw):
+                data = raw
+            else:
+                if image.mode in ('RGBA', 'LA', 'P'):
+                    rgba = image.convert('RGBA')
+                    flat = Image.new('RGB', rgba.size, 'white')
+                    flat.paste(rgba, mask=rgba.getchannel('A'))
+                else:
+                    flat = image.convert('RGB')
+                data = self._fit(flat)
+                mime_type = 'image/jpeg'
+                print(f"Re-encoded {image_path}: {len(raw)} -> {len(data)} bytes")
+
+        encoded = (base64.b64encode(data).decode(), mime_type)
+        with self._lock:
+            if cache_key not in self._cache:
+                self._cache[cache_key] = encoded
+                self.original_bytes += len(raw)
+                self.encoded_bytes += len(data)
+                if data is not raw:
+                    self.reencoded += 1
+        return encoded
+
+    def stats(self):
+        """Payload sizes of the crops encoded so far"""
+        with self._lock:
+            return {
+                'images': len(self._cache),
+                'reencoded': self.reencoded,
+                'original_bytes': self.original_bytes,
+                'encoded_bytes': self.encoded_bytes,
+                'bytes_saved': self.original_bytes - self.encoded_bytes,
+                'max_b64_bytes': self.max_b64_bytes
+            }
+
 
 class VisionAnalyzer:
-    def __init__(self, api_key):
-        """Initialize the vision analyzer with API key"""
+    def __init__(self, api_key, requests_per_second=1.0, max_in_flight=4, max_retries=3, timeout=60.0):
+        """Initialize the vision analyzer with API key, request rate limits and per-call timeout"""
         self.api_key = "Your api key here"
         self.invoke_url = "https://integrate.api.nvidia.com/v1/chat/completions"
         self.headers = {
             "Authorization": f"Bearer {api_key}",
             "Accept": "application/json"
         }
+        self.rate_limiter = RateLimiter(requests_per_second, max_in_flight)
+        self.max_retries = max_retries
+        self.timeout = timeout
+        self.encoder = ImageEncoder()
 
-    def find_media_reference(self, text, media_type, page_num):
-        """Find reference to a specific figure/table in text"""
-        # Broader patterns for finding references
-        patterns = [
-            f"{media_type}\.?\s*{page_num}",           # Fig. 1 or Table 1
-            f"{media_type}\.?\s*\[{page_num}\]",       # Fig. [1] or Table [1]
-            f"{media_type}\.?\s*\({page_num}\)",       # Fig. (1) or Table (1)
-            f"(?:see|in)\s+{media_type}\.?\s*{page_num}",  # see Fig. 1 or in Table 1
-        ]
-        
-        # Get all matches from all patterns
-        contexts = []
-        for pattern in patterns:
-            matches = list(re.finditer(pattern, text, re.IGNORECASE))
-            for match in matches:
-                # Get wider context around match
-                start = max(0, match.start() - 1000)
-                end = min(len(text), match.end() + 1000)
-                
-                # Find sentence boundaries
-                context_text = text[start:end]
-                sentences = re.split(r'(?<=[.!?])\s+', context_text)
-                
-                # Get sentences containing and surrounding the match
-                match_pos = match.start() - start
-                for i, sentence in enumerate(sentences):
-                    if match_pos <= len(sentence):
-                        # Get surrounding sentences
-                        start_idx = max(0, i - 2)
-                        end_idx = min(len(sentences), i + 3)
-                        context = ' '.join(sentences[start_idx:end_idx])
-                        contexts.append(context)
-                        break
-                    match_pos -= len(sentence) + 1
-                    
-        return ' '.join(contexts) if contexts else text
-
-    def get_page_context(self, pages, current_page_num):
-        """Get context from current and adjacent pages"""
-        context_text = []
+    def _post(self, payload):
+        """Send a request through the rate limiter, retrying throttled and failed calls"""
+        for attempt in range(self.max_retries + 1):
+            self.rate_limiter.acquire()
+            try:
+                response = get_http_client().post(
+                    self.invoke_url,
+                    headers=self.headers,
+                    json=payload,
+                    timeout=self.timeout
+                )
+            finally:
+                self.rate_limiter.release()
+            
+            if response.status_code != 429 and response.status_code < 500:
+                self.rate_limiter.on_success()
+                return response
+            
+            self.rate_limiter.on_throttle()
+            print(f"Request throttled ({response.status_code}), rate now {self.rate_limiter.rate:.2f} req/s")
+            retry_after = response.headers.get('Retry-After', '')
+            if retry_after.isdigit() and attempt < self.max_retries:
+                time.sleep(int(retry_after))
         
-        # Get text from previous, current, and next page
-        for page in pages:
-            if abs(page['page_num'] - current_page_num) <= 1:  # Include adjacent pages
-                if 'text' in page:
-                    context_text.append(page['text'])
-                    
-        return '\n'.join(context_text)
-
-    def analyze_image(self, image_path, pages, current_page, media_type, page_num):
-        """Analyze a single image with document context"""
+        return response
+
+    def analyze_image(self, image_path, reference_context, media_type):
+        """Analyze a single image with the sentences that reference it"""
         try:
-            # Read and encode image
-            with open(image_path, "rb") as f:
-                image_b64 = base64.b64encode(f.read()).decode()
-
-            # Check size limit
-            if len(image_b64) >= 180_000:
-                print(f"Warning: Image {image_path} is too large (>180KB)")
-                return None
-
-            # Get context but limit it to ~500 characters to avoid token limit
-            page_context = self.get_page_context(pages, current_page['page_num'])
-            reference_context = self.find_media_reference(page_context, media_type, page_num)
-            truncated_context = reference_context[:500] + "..." if len(reference_context) > 500 else reference_context
-            
+            # Encoded once per crop, shrunk to fit the inline size limit if needed
+            image_b64, mime_type = self.encoder.encode(image_path)
+
             # Prepare different prompts for figures and tables
             if media_type.lower() == 'figure':
                 prompt = f"""Based on this figure and the surrounding text, provide a concise analysis:
 
-    Context: {truncated_context}
+    Context: {reference_context}
 
     1. Contextual Placement:
     - How this figure relates to the text passage
@@ -105,7 +330,7 @@ class VisionAnalyzer:
             else:  # Table
                 prompt = f"""Based on this table and the surrounding text, provide a concise analysis:
 
-    Context: {truncated_context}
+    Context: {reference_context}
 
     1. Data Organization:
     - Structure and content overview
@@ -126,7 +351,7 @@ class VisionAnalyzer:
                 "messages": [
                     {
                         "role": "user",
-                        "content": f'{prompt} <img src="data:image/jpeg;base64,{image_b64}" />'
+                        "content": f'{prompt} <img src="data:{mime_type};base64,{image_b64}" />'
                     }
                 ],
                 "max_tokens": 512,
@@ -135,16 +360,25 @@ class VisionAnalyzer:
                 "stream": False
             }
 
-            response = requests.post(self.invoke_url, headers=self.headers, json=payload)
+            # The payload carries the model, prompt, sampling params and image bytes
+            cache = get_response_cache()
+            cache_key = cache.key(payload)
+            if (cached := cache.get(cache_key)) is not None:
+                print(f"Using cached analysis for {image_path}")
+                return cached
+
+            response = self._post(payload)
             
             if response.status_code == 200:
                 result = response.json()
                 if 'choices' in result and len(result['choices']) > 0:
-                    return {
+                    analysis = {
                         'description': result['choices'][0]['message']['content'],
-                        'context_used': True,
-                        'reference_text': truncated_context
+                        'context_used': bool(reference_context),
+                        'reference_text': reference_context
                     }
+                    cache.set(cache_key, analysis)
+                    return analysis
             
             print(f"Error analyzing image {image_path}: {response.text}")
             return None
@@ -152,8 +386,74 @@ class VisionAnalyzer:
         except Exception as e:
             print(f"Error processing image {image_path}: {e}")
             return None
-    def process_results_file(self, results_path):
-        """Process a results.json file and add descriptions to all images"""
+    def _media_context(self, media, page, media_type, number, reference_index):
+        """The caption plus the sentences that cite this item, rather than raw page text"""
+        caption = media.get('caption', '')
+        if not caption:
+            entry = reference_index.get(media_key(media_type, number))
+            caption = entry['captions'][0]['text'] if entry and entry['captions'] else ''
+        mentions = get_reference_context(reference_index, media_type, number, page['page_num'], max_chars=MAX_MENTION_CHARS)
+        return f"Caption: {caption[:MAX_CAPTION_CHARS]}\n{mentions}" if caption else mentions
+
+    def _analyze_media(self, media, page, media_type, number, reference_index):
+        """Analyze one table or figure and write the result into its dict"""
+        print(f"Analyzing {media_type.lower()} {number} on page {page['page_num']}")
+        reference_context = self._media_context(media, page, media_type, number, reference_index)
+        analysis = self.analyze_image(media['file_path'], reference_context, media_type)
+        if analysis:
+            media['description'] = analysis['description']
+            media['context_found'] = analysis['context_used']
+            media['reference_text'] = analysis['reference_text']
+
+    def _describe_table_locally(self, table, page, number, reference_index):
+        """Describe a table from its extracted cell grid instead of calling the vision model"""
+        with open(table['structure']['csv_path'], 'r', encoding='utf-8') as f:
+            cells = f.read()
+        if len(cells) > MAX_TABLE_CSV_CHARS:
+            cells = cells[:MAX_TABLE_CSV_CHARS] + "..."
+        
+        reference_context = self._media_context(table, page, "Table", number, reference_index)
+        table['description'] = (
+            f"Table with {table['structure']['rows']} rows and {table['structure']['columns']} columns "
+            f"(CSV):\n{cells}"
+        )
+        table['context_found'] = bool(reference_context)
+        table['reference_text'] = reference_context
+        table['description_source'] = 'table_structure'
+
+    def _analyze_group(self, group, reference_index):
+        """Analyze one crop of a duplicate group and copy its description to the rest
+        
+        Members are tried in order until one is described; each duplicate keeps the
+        captions and mentions of its own number.
+        """
+        for media, page, media_type, number in group:
+            self._analyze_media(media, page, media_type, number, reference_index)
+            if 'description' in media:
+                break
+        else:
+            return
+
+        for duplicate, duplicate_page, _, duplicate_number in group:
+            if duplicate is media:
+                continue
+            print(f"Reusing description of {media['file_path']} for {duplicate['file_path']} "
+                  f"on page {duplicate_page['page_num']}")
+            reference_context = self._media_context(duplicate, duplicate_page, media_type,
+                                                    duplicate_number, reference_index)
+            duplicate['description'] = media['description']
+            duplicate['context_found'] = bool(reference_context)
+            duplicate['reference_text'] = reference_context
+            duplicate['duplicate_of'] = media['file_path']
+
+    def process_results_file(self, results_path, max_workers=1, dedup=True, max_hash_distance=DEFAULT_HASH_DISTANCE, local_tables=False):
+        """Process a results.json file and add descriptions to all images
+        
+        With max_workers > 1, images are analyzed concurrently; the rate limiter
+        still bounds requests/second and requests in flight. With dedup, near-identical
+        crops (logos, repeated legends) are sent to the model once per group. With
+        local_tables, tables whose cell grid was extracted during OCR skip the vision model.
+        """
         try:
             # Load results file
             with open(results_path, 'r', encoding='utf-8') as f:
@@ -161,44 +461,62 @@ class VisionAnalyzer:
 
             print(f"Processing results from: {results_path}")
             
-            # Process each page
-            for page in results['pages']:
-                page_num = page['page_num']
-                print(f"\nProcessing page {page_num}")
+            # One pass over the document text instead of a rescan per image
+            if 'reference_index' not in results:
+                results['reference_index'] = build_reference_index(results['pages'])
+            reference_index = results['reference_index']
 
-                # Process tables
-                for i, table in enumerate(page['tables'], 1):
+            # Collect tables first, then figures, page by page. Without a parsed
+            # label, the Nth figure (or table) of the document is taken to be number N.
+            tasks = []
+            table_count = figure_count = 0
+            for page in results['pages']:
+                for table in page['tables']:
+                    table_count += 1
+                    number = table.get('number', table_count)
+                    if local_tables and table.get('structure', {}).get('rows'):
+                        try:
+                            self._describe_table_locally(table, page, number, reference_index)
+                            continue
+                        except (OSError, KeyError, ValueError) as e:
+                            print(f"Could not describe table {number} from its cell grid, using the vision model: {e}")
                     if 'file_path' in table:
-                        print(f"Analyzing table {i} on page {page_num}")
-                        analysis = self.analyze_image(
-                            table['file_path'],
-                            results['pages'],  # Pass all pages for context
-                            page,
-                            "Table",
-                            i
-                        )
-                        if analysis:
-                            table['description'] = analysis['description']
-                            table['context_found'] = analysis['context_used']
-                            table['reference_text'] = analysis['reference_text']
-                            time.sleep(1)  # Rate limiting
-
-                # Process figures
-                for i, figure in enumerate(page['figures'], 1):
+                        tasks.append((table, page, "Table", number))
+                for figure in page['figures']:
+                    figure_count += 1
                     if 'file_path' in figure:
-                        print(f"Analyzing figure {i} on page {page_num}")
-                        analysis = self.analyze_image(
-                            figure['file_path'],
-                            results['pages'],  # Pass all pages for context
-                            page,
-                            "Figure",
-                            i
-                        )
-                        if analysis:
-                            figure['description'] = analysis['description']
-                            figure['context_found'] = analysis['context_used']
-                            figure['reference_text'] = analysis['reference_text']
-                            time.sleep(1)  # Rate limiting
+                        tasks.append((figure, page, "Figure", figure.get('number', figure_count)))
+            
+            if dedup:
+                groups = group_duplicate_media(tasks, max_hash_distance)
+                results['media_dedup'] = {
+                    'hash': 'dhash64+pixels',
+                    'media_types': list(DEDUP_MEDIA_TYPES),
+                    'max_distance': max_hash_distance,
+                    'media_count': len(tasks),
+                    'group_count': len(groups),
+                    'duplicates_skipped': len(tasks) - len(groups),
+                    'groups': [
+                        [media['file_path'] for media, _, _, _ in group]
+                        for group in groups if len(group) > 1
+                    ]
+                }
+                print(f"Found {len(groups)} distinct images among {len(tasks)} tables and figures")
+            else:
+                groups = [[task] for task in tasks]
+
+            print(f"Analyzing {len(groups)} tables and figures with {max_workers} workers")
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                futures = [
+                    executor.submit(self._analyze_group, group, reference_index)
+                    for group in groups
+                ]
+                for future in as_completed(futures):
+                    future.result()
+
+            results['media_encoding'] = self.encoder.stats()
+            print(f"Image payloads: {results['media_encoding']['reencoded']} re-encoded, "
+                  f"{results['media_encoding']['bytes_saved']} bytes saved")
 
             # Save updated results
             output_path = Path(results_path).parent / 'results_with_descriptions.json'
@@ -213,10 +531,10 @@ class VisionAnalyzer:
             return None
 
 
-def analyze_paper_media(results_path, api_key):
+def analyze_paper_media(results_path, api_key, max_workers=1, requests_per_second=1.0, max_in_flight=4, dedup=True, local_tables=False):
     """Helper function to analyze media in a paper's results"""
-    analyzer = VisionAnalyzer(api_key)
-    return analyzer.process_results_file(results_path)
+    analyzer = VisionAnalyzer(api_key, requests_per_second, max_in_flight)
+    return analyzer.process_results_file(results_path, max_workers, dedup=dedup, local_tables=local_tables)
 
 if __name__ == "__main__":
     # Example usage